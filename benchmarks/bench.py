@@ -0,0 +1,273 @@
+'''
+bench.py
+
+Offline benchmarks of the pyBGG parsing and fetch stages, against the
+recorded fixtures and the local stub server in stubserver.py. No request
+leaves the machine.
+
+Each stage runs in a forked child process, so that its peak memory can be
+measured apart from the others. For each stage, report the number of items
+processed, the throughput, the latency percentiles of its operations, and the
+growth in peak resident memory.
+
+Usage: python bench.py [options] [stage ...]
+'''
+
+import argparse
+import json
+import os
+import resource
+import StringIO
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyBGG
+import stubserver
+
+def percentile(values, p):
+    '''
+    Return the p-th percentile of the values, by the nearest-rank method.
+    '''
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+def timed(fn, repeat):
+    '''
+    Call fn repeat times. Return the total number of items it reports and
+    the list of call latencies.
+    '''
+    items = 0
+    latencies = [ ]
+    for n in range(repeat):
+        start = time.time()
+        items += fn()
+        latencies.append(time.time() - start)
+    return items, latencies
+
+def boardgameElement(name, engine):
+    tree = pyBGG.parseXml(stubserver.loadFixture(name), engine)
+    return pyBGG.findElements(tree, 'boardgame')[0]
+
+def stageParseGame(options, engine):
+    xml = stubserver.loadFixture('boardgame.xml')
+    return timed(lambda: len([pyBGG.parseBoardgame(
+        pyBGG.findElements(pyBGG.parseXml(xml, engine), 'boardgame')[0])]), options.repeat * 10)
+
+def stageParseLazy(options):
+    xml = stubserver.boardgamesXml(stubserver.loadFixture('boardgame.xml'),
+                                   range(1, pyBGG.GAMES_BATCH_SIZE + 1))
+    return timed(lambda: sum(1 for b in pyBGG.findElements(pyBGG.parseXml(xml, 'lxml'), 'boardgame')
+                             if pyBGG.LazyGame(b).get('BOARDGAMERANK')), options.repeat * 10)
+
+def stageParseCollection(options, engine):
+    xml = stubserver.scaleCollection(stubserver.loadFixture('collection.xml'),
+                                     options.collection_size)
+    return timed(lambda: len(pyBGG.parseCollection(xml, engine = engine)), options.repeat)
+
+def stageStreamCollection(options):
+    xml = stubserver.scaleCollection(stubserver.loadFixture('collection.xml'),
+                                     options.collection_size)
+    return timed(lambda: sum(1 for game in
+        pyBGG.iterCollection(StringIO.StringIO(xml))), options.repeat)
+
+def stageRecords(options, compact):
+    collection = pyBGG.parseCollection(stubserver.loadFixture('collection.xml'), engine = 'lxml')
+    game = pyBGG.parseBoardgame(boardgameElement('boardgame.xml', 'lxml'))
+    games = pyBGG.mergeCollection(collection, [game])
+    n = options.collection_size
+    def build():
+        if compact:
+            records = [pyBGG.Game.fromDict(games[i % len(games)]) for i in range(n)]
+            return sum(1 for r in records if r.title)
+        records = [dict(games[i % len(games)]) for i in range(n)]
+        return sum(1 for r in records if r['TITLE'])
+    return timed(build, 1)
+
+def stageGetGame(options):
+    return timed(lambda: len([pyBGG.getGameById(5)]), options.repeat * 10)
+
+def stageGetGames(options):
+    ids = range(1, options.collection_size + 1)
+    return timed(lambda: len(pyBGG.getGamesByIds(ids, engine = options.engine)), options.repeat)
+
+def stageCollection(options):
+    return timed(lambda: len(pyBGG.getCollectionByUserAndId('bench', engine = options.engine)),
+                 options.repeat)
+
+def stageConcurrentCollection(options):
+    client = pyBGG.ConcurrentClient(engine = options.engine)
+    return timed(lambda: len(client.getCollection('bench')), options.repeat)
+
+def stageCollections(options):
+    users = ['bench%d' % n for n in range(10)]
+    return timed(lambda: sum(len(c) for c in
+                             pyBGG.getCollectionsByUsers(users, engine = options.engine).values()),
+                 options.repeat)
+
+def stageMarketplace(options):
+    return timed(lambda: len([pyBGG.getMarketplaceById(111, engine = options.engine)]),
+                 options.repeat * 10)
+
+def stageGeekbay(options):
+    page = stubserver.loadFixture('geekbay.html')
+    return timed(lambda: sum(len(a) for a in pyBGG.parseGeekbayPage(page).values()),
+                 options.repeat * 10)
+
+def stageGeekbayCrawl(options):
+    url = pyBGG.BGG_URL + '/geekbay/browse?filterwanttobuy=1&sort=endtime'
+    return timed(lambda: sum(1 for a in pyBGG.crawlGeekbay(url)), options.repeat)
+
+STAGES = [
+    ('parse-game-bs4', lambda o: stageParseGame(o, 'bs4')),
+    ('parse-game-lxml', lambda o: stageParseGame(o, 'lxml')),
+    ('parse-game-lazy', stageParseLazy),
+    ('parse-collection-bs4', lambda o: stageParseCollection(o, 'bs4')),
+    ('parse-collection-lxml', lambda o: stageParseCollection(o, 'lxml')),
+    ('stream-collection', stageStreamCollection),
+    ('records-dict', lambda o: stageRecords(o, False)),
+    ('records-game', lambda o: stageRecords(o, True)),
+    ('get-game', stageGetGame),
+    ('get-games', stageGetGames),
+    ('collection', stageCollection),
+    ('collection-concurrent', stageConcurrentCollection),
+    ('collections-multi', stageCollections),
+    ('marketplace', stageMarketplace),
+    ('geekbay', stageGeekbay),
+    ('geekbay-crawl', stageGeekbayCrawl),
+]
+
+def checkParity():
+    '''
+    Compare the bs4 and lxml parser engines, and lazy and eager game records,
+    field for field on the fixtures. Return a list of mismatch descriptions.
+    '''
+    mismatches = [ ]
+    pairs = [ ]
+    for name in ['boardgame.xml', 'marketplace.xml']:
+        pairs.append((name, pyBGG.parseBoardgame(boardgameElement(name, 'bs4')),
+                      pyBGG.parseBoardgame(boardgameElement(name, 'lxml'))))
+    # A wishlist comment, which only a logged-in user's requests carry.
+    xml = stubserver.loadFixture('boardgame.xml').replace('</boardgame>',
+        '<wishlistcomment>WTB=20 NOTE=x</wishlistcomment></boardgame>', 1)
+    for name, xml in [('boardgame.xml', stubserver.loadFixture('boardgame.xml')),
+                      ('marketplace.xml', stubserver.loadFixture('marketplace.xml')),
+                      ('boardgame.xml with wishlistcomment', xml)]:
+        boardgame = pyBGG.findElements(pyBGG.parseXml(xml, 'lxml'), 'boardgame')[0]
+        eager = pyBGG.parseBoardgame(boardgame)
+        pairs.append(('%s lazy keys' % name, eager, dict(pyBGG.LazyGame(boardgame))))
+        # Each key read first from a fresh LazyGame, so by its own section.
+        lazy = { }
+        for key in eager:
+            try:
+                lazy[key] = pyBGG.LazyGame(boardgame)[key]
+            except KeyError:
+                pass
+        pairs.append(('%s lazy fields' % name, eager, lazy))
+    xml = stubserver.loadFixture('collection.xml')
+    for a, b in zip(pyBGG.parseCollection(xml, engine = 'bs4'),
+                    pyBGG.parseCollection(xml, engine = 'lxml')):
+        pairs.append(('collection.xml item %d' % a['BGGID'], a, b))
+    for name, a, b in pairs:
+        for key in sorted(set(a) | set(b)):
+            if a.get(key) != b.get(key):
+                mismatches.append('%s: %s: %r != %r' % (name, key, a.get(key), b.get(key)))
+    return mismatches
+
+def runStage(fn, options):
+    '''
+    Run a stage in a forked child process. Return a hash of its results.
+    '''
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        result = { }
+        try:
+            if options.metrics:
+                pyBGG.enableMetrics()
+            base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.time()
+            items, latencies = fn(options)
+            elapsed = time.time() - start
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+            result = {
+                'items':items,
+                'seconds':elapsed,
+                'itemspersec':items / elapsed if elapsed else 0.0,
+                'p50ms':percentile(latencies, 50) * 1000,
+                'p90ms':percentile(latencies, 90) * 1000,
+                'p99ms':percentile(latencies, 99) * 1000,
+                'peakmb':peak / 1024.0,
+            }
+            if options.metrics:
+                result['metrics'] = pyBGG.getStats()
+        except Exception as e:
+            result = { 'error':'%s: %s' % (type(e).__name__, e) }
+        os.write(wfd, json.dumps(result))
+        os.close(wfd)
+        os._exit(0)
+    os.close(wfd)
+    data = ''
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Offline pyBGG benchmarks.')
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help='stages to run (default: all): ' + ', '.join([n for n, f in STAGES]))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--collection-size', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='stub server latency per request, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of stub server requests failing with 503')
+    parser.add_argument('--engine', default='lxml', help='parser engine for fetch stages')
+    parser.add_argument('--json', action='store_true', help='write results as JSON')
+    parser.add_argument('--metrics', action='store_true',
+                        help='record pyBGG stage metrics in the JSON results')
+    options = parser.parse_args(argv)
+
+    server = stubserver.StubServer(latency = options.latency,
+                                   error_rate = options.error_rate,
+                                   collection_size = options.collection_size)
+    pyBGG.BGG_URL = server.start()
+
+    mismatches = checkParity()
+    results = [ ]
+    for name, fn in STAGES:
+        if options.stages and name not in options.stages:
+            continue
+        result = runStage(fn, options)
+        result['stage'] = name
+        results.append(result)
+    server.stop()
+
+    if options.json:
+        print json.dumps({ 'parity':mismatches, 'stages':results }, indent=1, sort_keys=True)
+        return 0
+    print 'Parser parity (bs4 vs. lxml, lazy vs. eager):', 'OK' if not mismatches else 'MISMATCH'
+    for mismatch in mismatches:
+        print '  ', mismatch
+    print
+    print '%-22s %8s %10s %10s %10s %10s %8s' % ('stage', 'items', 'items/s',
+                                                 'p50 ms', 'p90 ms', 'p99 ms', 'peak MB')
+    for r in results:
+        if 'error' in r:
+            print '%-22s %s' % (r['stage'], r['error'])
+        else:
+            print '%-22s %8d %10.1f %10.2f %10.2f %10.2f %8.1f' % (r['stage'], r['items'],
+                r['itemspersec'], r['p50ms'], r['p90ms'], r['p99ms'], r['peakmb'])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
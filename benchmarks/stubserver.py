@@ -0,0 +1,201 @@
+'''
+stubserver.py
+
+A local stand-in for the BoardGameGeek.com web site, serving the recorded
+fixtures in the fixtures directory, for offline benchmarks. Set pyBGG.BGG_URL
+to the URL returned by StubServer.start.
+
+- /xmlapi/boardgame/ID,ID,...?stats=1: one boardgame element per ID, from
+  boardgame.xml.
+- /xmlapi/boardgame/ID&marketplace=1: marketplace.xml.
+- /xmlapi/collection/USER: collection.xml, optionally repeated to a given
+  number of items, and optionally answered "queued" (HTTP 202) a given number
+  of times first.
+- /recentadditions/rss: wishlist.rss.
+- /geekbay/browse[?...&pageid=N]: geekbay.html, as page N of 3, with the
+  auction IDs of page N made distinct.
+
+Responses carry an ETag and honor If-None-Match, and are gzipped if the
+client accepts it. Each request may be delayed by a fixed latency, and may
+fail with HTTP 503 at a given rate (from a seeded random number generator, so
+that runs are repeatable).
+
+Usage: python stubserver.py [port [latency [error_rate]]]
+'''
+
+import BaseHTTPServer
+import gzip
+import hashlib
+import os
+import random
+import re
+import SocketServer
+import StringIO
+import sys
+import threading
+import time
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+QUEUED_MESSAGE = '''<?xml version="1.0" encoding="utf-8" standalone="yes"?>
+<message>
+	Your request for this collection has been accepted and will be processed.  Please try again later for access.
+</message>'''
+
+boardgames_re = re.compile(r'/xmlapi/boardgame/([\d,]+)(&marketplace=1)?')
+boardgame_re = re.compile(r'<boardgame objectid="\d+">.*</boardgame>', re.DOTALL)
+item_re = re.compile(r'<item .*?</item>', re.DOTALL)
+pageid_re = re.compile(r'[?&]pageid=(\d+)')
+auctionid_re = re.compile(r'/geekbay/item/(\d+)')
+
+def loadFixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+        return f.read()
+
+def boardgamesXml(template, ids):
+    '''
+    Return a boardgames document with a copy of the boardgame element of the
+    template for each of the specified IDs.
+    '''
+    boardgame = boardgame_re.search(template).group(0)
+    head, tail = template.split(boardgame)
+    return head + '\n  '.join([re.sub(r'objectid="\d+"', 'objectid="%s"' % id, boardgame, 1)
+                               for id in ids]) + tail
+
+def scaleCollection(xml, size):
+    '''
+    Return the collection XML with its items repeated, with distinct object
+    and collection IDs, to the specified number of items.
+    '''
+    items = item_re.findall(xml)
+    head = xml[:xml.index(items[0])]
+    tail = xml[xml.rindex(items[-1]) + len(items[-1]):]
+    scaled = [ ]
+    for n in range(size):
+        item = items[n % len(items)]
+        item = re.sub(r'objectid="\d+"', 'objectid="%d"' % (n + 1), item, 1)
+        item = re.sub(r'collid="\d+"', 'collid="%d"' % (n + 1), item, 1)
+        scaled.append(item)
+    return head + '\n  '.join(scaled) + tail
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class StubServer(object):
+
+    def __init__(self, port = 0, latency = 0.0, error_rate = 0.0, queued = 0,
+                 collection_size = None, seed = 0):
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.queued = queued
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.polls = { }
+        self.boardgame = loadFixture('boardgame.xml')
+        self.marketplace = loadFixture('marketplace.xml')
+        self.collection = loadFixture('collection.xml')
+        if collection_size:
+            self.collection = scaleCollection(self.collection, collection_size)
+        self.rss = loadFixture('wishlist.rss')
+        self.geekbay = loadFixture('geekbay.html')
+        self.httpd = None
+
+    def respond(self, path):
+        '''
+        Return the status, content type and body for the specified path.
+        '''
+        m = boardgames_re.match(path)
+        if m and m.group(2):
+            return 200, 'text/xml', boardgamesXml(self.marketplace, [m.group(1)])
+        if m:
+            return 200, 'text/xml', boardgamesXml(self.boardgame, m.group(1).split(','))
+        if path.startswith('/xmlapi/collection/'):
+            with self.lock:
+                self.polls[path] = self.polls.get(path, 0) + 1
+                polls = self.polls[path]
+            if polls <= self.queued:
+                return 202, 'text/xml', QUEUED_MESSAGE
+            return 200, 'text/xml', self.collection
+        if path.startswith('/recentadditions/rss'):
+            return 200, 'application/rss+xml', self.rss
+        if path.startswith('/geekbay/browse'):
+            m = pageid_re.search(path)
+            if not m or m.group(1) == '1':
+                return 200, 'text/html', self.geekbay
+            return 200, 'text/html', auctionid_re.sub(lambda a: '/geekbay/item/%d'
+                % (int(m.group(1)) * 100000 + int(a.group(1))), self.geekbay)
+        return 404, 'text/plain', 'Not found'
+
+    def handler(self):
+        server = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Buffer the response, and send it without waiting on Nagle's
+            # algorithm, so keep-alive connections see no artificial delay.
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                    fail = server.random.random() < server.error_rate
+                    if fail:
+                        server.errors += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                if fail:
+                    status, ctype, body = 503, 'text/plain', 'Service unavailable'
+                else:
+                    status, ctype, body = server.respond(self.path)
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(status)
+                self.send_header('Content-Type', ctype)
+                self.send_header('ETag', etag)
+                if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                    buf = StringIO.StringIO()
+                    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                        f.write(body)
+                    body = buf.getvalue()
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+    def start(self):
+        '''
+        Serve on a background thread. Return the base URL.
+        '''
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', self.port), self.handler())
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%d' % self.httpd.server_port
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+if __name__ == '__main__':
+    args = sys.argv[1:] + [None] * 3
+    server = StubServer(port = int(args[0] or 8000),
+                        latency = float(args[1] or 0.0),
+                        error_rate = float(args[2] or 0.0))
+    print 'Serving fixtures at', server.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.stop()
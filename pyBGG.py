@@ -5,77 +5,14 @@ Modules for using the BoardGameGeek.com web site.
 
 To Do:
 test
-- Cache collection data.
-- Implement getWishlistByUserId to return a collection of items (within a channel, within an rss):
-
-  <item>
-   <title>
-    Item For Sale: Liberty Roads
-   </title>
-   <description>
-    &lt;p&gt;by &lt;a  href='http://boardgamegeek.com/user/jjdenver'&gt;jjdenver&lt;/a&gt;&lt;/p&gt;
-	
-		&lt;a  href="http://boardgamegeek.com/geekstore.php3?action=viewitem&amp;itemid=522244"   &gt;$42.00&lt;/a&gt;
-			for Board Game:
-			&lt;a  href="http://boardgamegeek.com/boardgame/39188/liberty-roads"   &gt;Liberty Roads&lt;/a&gt;&lt;br&gt;
-			Condition: Like New&lt;br&gt;
-			Location: United States
-   </description>
-   <link>
-    http://boardgamegeek.com/geekstore.php3?action=viewitem&amp;itemid=522244
-   </link>
-   <guid>
-    http://boardgamegeek.com/geekstore.php3?action=viewitem&amp;itemid=522244
-   </guid>
-   <pubDate>
-    Sun, 29 Sep 2013 03:09:27 +0000
-   </pubDate>
-   <dc:creator>
-    jjdenver
-   </dc:creator>
-  </item>
-
-    <item>
-   <title>
-    Item For Sale: The Supreme Commander
-   </title>
-   <description>
-    &lt;p&gt;by &lt;a  href='http://boardgamegeek.com/user/cdatkins'&gt;cdatkins&lt;/a&gt;&lt;/p&gt;
-	
-		&lt;a  href="http://boardgamegeek.com/geekstore.php3?action=viewitem&amp;itemid=522177"   &gt;$35.00&lt;/a&gt;
-			for Board Game:
-			&lt;a  href="http://boardgamegeek.com/boardgame/39066/the-supreme-commander"   &gt;The Supreme Commander&lt;/a&gt;&lt;br&gt;
-			Condition: New&lt;br&gt;
-			Location: United States
-   </description>
-   <link>
-    http://boardgamegeek.com/geekstore.php3?action=viewitem&amp;itemid=522177
-   </link>
-   <guid>
-    http://boardgamegeek.com/geekstore.php3?action=viewitem&amp;itemid=522177
-   </guid>
-   <pubDate>
-    Sat, 28 Sep 2013 20:55:02 +0000
-   </pubDate>
-   <dc:creator>
-    cdatkins
-   </dc:creator>
-  </item>
- 
 - Use hash.update()
 - Get BGG marketplace items for specified game:
   http://www.boardgamegeek.com/xmlapi/boardgame/111&marketplace=1
 - Get eBay auctions for wishlist of logged-in user:
   http://www.boardgamegeek.com/geekbay/browse?filterwanttobuy=1&sort=endtime
-- Parse wishlistcomment
-- Support JSON or CSV dump of results
 - Load and save history file of seen marketplace offers and eBay auctions--by
   date so that
   restart and recovery are possible.
-- Capture history of all sales offers and auctions, in order to be able to
-  refine purchase offers: date, place (BGG/eBay), offer/auction id, BGG Id,
-  seller, price, description/condition.
-- Search history.  
 - Create proper docstrings.
 - Add and extract versions information:
   http://www.boardgamegeek.com/xmlapi/boardgame/701&versions=1
@@ -153,20 +90,636 @@ rating
 wishlistcomment
 '''
 
-from bs4 import BeautifulSoup
-from bs4 import element
-import ConfigParser
-import lxml.html
-import requests
+import atexit
+import collections
+import copy
+import datetime
+import functools
+import hashlib
+import heapq
+import importlib
+import json
+import os
+import random
+import re
 import sys
+import threading
+import time
 import traceback
-import urllib
+import weakref
+
+class LazyModule(object):
+    '''
+    Stand-in for a module, imported on first attribute access, so that
+    importing pyBGG, e.g. to run an offline command, does not pay for the
+    modules it does not use. A submodule, e.g. lxml.html, is imported when
+    accessed as an attribute.
+    '''
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module == None:
+            self._module = importlib.import_module(self._name)
+        try:
+            return getattr(self._module, attr)
+        except AttributeError:
+            return importlib.import_module(self._name + '.' + attr)
+
+bs4 = LazyModule('bs4')
+ConfigParser = LazyModule('ConfigParser')
+csv = LazyModule('csv')
+email = LazyModule('email')
+etree = LazyModule('lxml.etree')
+lxml = LazyModule('lxml')
+requests = LazyModule('requests')
+sqlite3 = LazyModule('sqlite3')
+urllib = LazyModule('urllib')
+urlparse = LazyModule('urlparse')
+webbrowser = LazyModule('webbrowser')
+
+def BeautifulSoup(*args, **kwargs):
+    return bs4.BeautifulSoup(*args, **kwargs)
+
+# Base URL of the BGG web site and XML APIs. May be pointed at a stub server.
+BGG_URL = 'http://www.boardgamegeek.com'
+
+# HTTP transport defaults. Times are in seconds. Requests failing with a
+# connection error, a timeout or one of HTTP_RETRY_STATUSES are retried up to
+# HTTP_RETRIES times, with exponential backoff from HTTP_BACKOFF.
+HTTP_TIMEOUT = 60
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 1.0
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Maximum number of IDs per request to the boardgame XML API.
+GAMES_BATCH_SIZE = 100
+
+# Incremental collection sync. Times are in seconds. Successive modifiedsince
+# windows overlap by SYNC_MARGIN, since BGG's clock and time zone are unknown.
+SYNC_DIR = os.path.join(os.path.expanduser('~'), '.pyBGG', 'sync')
+SYNC_FULL_INTERVAL = 7 * 24 * 60 * 60
+SYNC_MARGIN = 24 * 60 * 60
+
+# Local game catalog.
+CATALOG_FILE = os.path.join(os.path.expanduser('~'), '.pyBGG', 'catalog.db')
+CATALOG_BATCH_SIZE = 500
+
+# History of marketplace offers and auctions.
+HISTORY_DIR = os.path.join(os.path.expanduser('~'), '.pyBGG', 'history')
+
+# Default XML parser engine: 'bs4' (BeautifulSoup) or 'lxml' (lxml.etree).
+PARSER_ENGINE = 'bs4'
+
+# Default maximum number of requests in flight at once for ConcurrentClient.
+MAX_INFLIGHT = 8
+
+# Polling of queued collection requests. Times are in seconds.
+POLL_BACKOFF = 2.0
+POLL_MAX_BACKOFF = 60.0
+POLL_JITTER = 0.25
+POLL_TIMEOUT = 15 * 60
+
+# BGG answers a collection request it has queued for processing with HTTP
+# 202 and this message in place of the collection.
+queued_re = re.compile(r'<message>\s*Your request for this collection has been accepted', re.IGNORECASE)
+
+# Response cache defaults. TTLs are in seconds, by endpoint.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pyBGG', 'cache')
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_TTLS = {
+    'boardgame':7 * 24 * 60 * 60,
+    'collection':60 * 60,
+    'marketplace':60 * 60,
+    'rss':0,
+    'default':0,
+}
+
+class NullTimer(object):
+    '''
+    Context manager that does nothing, handed out while metrics are disabled.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class StageTimer(object):
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.stage, time.time() - self.start)
+        return False
+
+class Metrics(object):
+    '''
+    Instrumentation of the hot paths: per-stage timings (fetch, parsexml,
+    parse, description, enrich) and counters (requests, bytes, retries,
+    errors, games fetched, coalesced calls). Stages nest; e.g., enrich includes the fetch and parse
+    of the enriched records. While disabled, the default, recording costs
+    one attribute test.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.nulltimer = NullTimer()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # stage: [calls, total seconds, maximum seconds]
+            self.timings = { }
+            self.counters = { }
+
+    def timer(self, stage):
+        '''
+        Return a context manager recording the time spent in its block
+        against the specified stage.
+        '''
+        if not self.enabled:
+            return self.nulltimer
+        return StageTimer(self, stage)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            timing = self.timings.get(stage)
+            if timing == None:
+                timing = self.timings[stage] = [0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def count(self, name, n = 1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def stats(self):
+        '''
+        Return a hash of the timings, counters and, if httpGet is cached,
+        the HttpCache counters.
+        '''
+        with self.lock:
+            timings = { }
+            for stage, (calls, total, maximum) in self.timings.items():
+                timings[stage] = {
+                    'calls':calls,
+                    'seconds':total,
+                    'mean':total / calls,
+                    'max':maximum,
+                }
+            stats = { 'timings':timings, 'counters':dict(self.counters) }
+        if httpCache != None:
+            stats['cache'] = httpCache.stats()
+        return stats
+
+    def dumpJson(self, f):
+        json.dump(self.stats(), f, indent=1, sort_keys=True)
+        f.write('\n')
+
+    def dumpPrometheus(self, f):
+        '''
+        Write the stats in the Prometheus text exposition format.
+        '''
+        stats = self.stats()
+        lines = [ ]
+        for metric, key, mtype in [('pybgg_stage_calls_total', 'calls', 'counter'),
+                                   ('pybgg_stage_seconds_total', 'seconds', 'counter'),
+                                   ('pybgg_stage_seconds_max', 'max', 'gauge')]:
+            lines.append('# TYPE %s %s' % (metric, mtype))
+            for stage in sorted(stats['timings']):
+                lines.append('%s{stage="%s"} %r' % (metric, stage, stats['timings'][stage][key]))
+        for name in sorted(stats['counters']):
+            lines.append('# TYPE pybgg_%s_total counter' % name)
+            lines.append('pybgg_%s_total %d' % (name, stats['counters'][name]))
+        for name, value in sorted(stats.get('cache', { }).items()):
+            mtype = 'counter' if name in ['hits', 'misses', 'revalidations'] else 'gauge'
+            suffix = '_total' if mtype == 'counter' else ''
+            lines.append('# TYPE pybgg_cache_%s%s %s' % (name, suffix, mtype))
+            lines.append('pybgg_cache_%s%s %r' % (name, suffix, value))
+        f.write('\n'.join(lines) + '\n')
+
+    def dump(self, path, format = 'json'):
+        with open(path, 'w') as f:
+            if format == 'prometheus':
+                self.dumpPrometheus(f)
+            else:
+                self.dumpJson(f)
+
+metrics = Metrics()
+
+def enableMetrics(dump = None, format = 'json'):
+    '''
+    Start recording metrics. If a dump path is given, write the stats there
+    at exit, as 'json' or 'prometheus' text.
+    '''
+    metrics.enabled = True
+    if dump != None:
+        atexit.register(metrics.dump, dump, format)
+
+def getStats():
+    '''
+    Return a hash of the recorded metrics. See Metrics.stats.
+    '''
+    return metrics.stats()
+
+def timedStage(stage):
+    '''
+    Decorator recording the time spent in calls of a function against the
+    specified metrics stage.
+    '''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            if not metrics.enabled:
+                return fn(*args, **kwargs)
+            with StageTimer(metrics, stage):
+                return fn(*args, **kwargs)
+        return timed
+    return decorate
+
+# The HttpCache used by httpGet, if any. See setHttpCache.
+httpCache = None
+
+class HttpCache(object):
+    '''
+    On-disk cache of raw HTTP responses, keyed by URL. Safe for use from
+    multiple threads.
+
+    Each response is stored as a body file and a JSON metadata file named by
+    the SHA-1 of the URL. A response younger than the TTL for its endpoint
+    (see CACHE_TTLS) is served without touching the network; an older one is
+    revalidated with a conditional GET using its ETag and Last-Modified
+    headers. When the stored bodies exceed max_bytes, the least recently used
+    responses are evicted. Only status 200 responses are stored.
+
+    N.B.: The key is the URL alone, so responses fetched with different
+    logged-in sessions share entries.
+    '''
+
+    def __init__(self, directory = CACHE_DIR, ttls = None, max_bytes = CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttls = dict(CACHE_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.lock = threading.RLock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Least recently used first. File modification times record use.
+        entries = [ ]
+        for name in os.listdir(directory):
+            if name.endswith('.body'):
+                st = os.stat(os.path.join(directory, name))
+                entries.append((st.st_mtime, name[:-5], st.st_size))
+        entries.sort()
+        self.sizes = collections.OrderedDict()
+        for mtime, key, size in entries:
+            self.sizes[key] = size
+        self.size = sum(self.sizes.values())
+
+    def endpoint(self, url):
+        '''
+        Return the CACHE_TTLS endpoint name for the specified URL.
+        '''
+        if '/collection' in url:
+            return 'collection'
+        if 'marketplace=1' in url:
+            return 'marketplace'
+        if '/boardgame/' in url or '/thing' in url:
+            return 'boardgame'
+        if '/rss' in url:
+            return 'rss'
+        return 'default'
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def write(self, path, data):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def touch(self, key):
+        try:
+            os.utime(self.path(key, '.body'), None)
+        except OSError:
+            pass
+        self.sizes[key] = self.sizes.pop(key, 0)
+
+    def load(self, key):
+        '''
+        Return the metadata and body stored under the specified key, or
+        (None, None).
+        '''
+        if key not in self.sizes:
+            return None, None
+        try:
+            with open(self.path(key, '.meta'), 'rb') as f:
+                meta = json.load(f)
+            with open(self.path(key, '.body'), 'rb') as f:
+                body = f.read()
+        except (IOError, ValueError):
+            self.remove(key)
+            return None, None
+        return meta, body
+
+    def store(self, key, url, headers, body):
+        meta = {
+            'url':url,
+            'fetched':time.time(),
+            'etag':headers.get('etag'),
+            'lastmodified':headers.get('last-modified'),
+        }
+        self.remove(key)
+        self.write(self.path(key, '.body'), body)
+        self.write(self.path(key, '.meta'), json.dumps(meta))
+        self.sizes[key] = len(body)
+        self.size += len(body)
+        self.evict()
+
+    def remove(self, key):
+        self.size -= self.sizes.pop(key, 0)
+        for suffix in ['.body', '.meta']:
+            try:
+                os.remove(self.path(key, suffix))
+            except OSError:
+                pass
+
+    def evict(self):
+        '''
+        Remove least recently used responses until within max_bytes.
+        '''
+        while self.size > self.max_bytes and len(self.sizes) > 1:
+            self.remove(next(iter(self.sizes)))
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.sizes.keys()):
+                self.remove(key)
+
+    def get(self, url, fetch):
+        '''
+        Return the body for the specified URL, from the cache if fresh.
+        Otherwise call fetch(url, headers), which must return a tuple of
+        status, response headers and body, as httpRequest does.
+        '''
+        key = hashlib.sha1(url).hexdigest()
+        headers = { }
+        with self.lock:
+            meta, body = self.load(key)
+            if meta:
+                if time.time() - meta['fetched'] < self.ttls[self.endpoint(url)]:
+                    self.hits += 1
+                    self.touch(key)
+                    return body
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('lastmodified'):
+                    headers['If-Modified-Since'] = meta['lastmodified']
+        status, rheaders, rbody = fetch(url, headers)
+        with self.lock:
+            if status == 304 and meta:
+                self.hits += 1
+                self.revalidations += 1
+                meta['fetched'] = time.time()
+                self.write(self.path(key, '.meta'), json.dumps(meta))
+                self.touch(key)
+                return body
+            self.misses += 1
+            if status == 200:
+                self.store(key, url, rheaders, rbody)
+        return rbody
+
+    def stats(self):
+        '''
+        Return a hash of the cache counters.
+        '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits':self.hits,
+                'misses':self.misses,
+                'revalidations':self.revalidations,
+                'hitratio':float(self.hits) / lookups if lookups else 0.0,
+                'entries':len(self.sizes),
+                'bytes':self.size,
+            }
+
+def setHttpCache(cache):
+    '''
+    Install the specified HttpCache (or None) under httpGet.
+    '''
+    global httpCache
+    httpCache = cache
+
+class Transport(object):
+    '''
+    HTTP transport shared by the fetch functions: a requests session with a
+    pool of keep-alive connections, gzip compression, and retry of transient
+    failures with exponential backoff. Response bodies are returned as the raw
+    bytes received, for the XML parsers to decode.
+    '''
+
+    def __init__(self, session = None, pool_size = HTTP_POOL_SIZE,
+                 retries = HTTP_RETRIES, backoff = HTTP_BACKOFF,
+                 timeout = HTTP_TIMEOUT):
+        if session == None:
+            session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size,
+                                                pool_maxsize = pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session = session
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def send(self, url, headers = None, stream = False):
+        '''
+        Send a GET request, retrying transient failures. Return the
+        requests response.
+        '''
+        attempt = 0
+        while True:
+            metrics.count('requests')
+            try:
+                r = self.session.get(url, headers = headers, stream = stream,
+                                     timeout = self.timeout)
+                if r.status_code not in HTTP_RETRY_STATUSES or attempt >= self.retries:
+                    if r.status_code >= 400:
+                        metrics.count('errors')
+                    return r
+                r.close()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    metrics.count('errors')
+                    raise
+            metrics.count('retries')
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def request(self, url, headers = None):
+        '''
+        Return a tuple of the HTTP status code, a hash of the response headers
+        (lowercase names), and the body.
+        '''
+        with metrics.timer('fetch'):
+            r = self.send(url, headers = headers)
+            body = r.content
+        rheaders = dict((k.lower(), v) for k, v in r.headers.items())
+        metrics.count('bytes', len(body))
+        return r.status_code, rheaders, body
+
+    def open(self, url, headers = None):
+        '''
+        Return a tuple of the HTTP status code and a file-like object
+        streaming the decompressed body. Its getheader method returns the
+        response headers.
+        '''
+        with metrics.timer('fetch'):
+            r = self.send(url, headers = headers, stream = True)
+        r.raw.decode_content = True
+        return r.status_code, r.raw
+
+# Transports of the default session and of the sessions passed by callers.
+defaultTransport = None
+sessionTransports = weakref.WeakKeyDictionary()
+transportLock = threading.Lock()
+
+def getTransport(session = None):
+    '''
+    Return the Transport for the specified requests session (e.g., as
+    returned by login), or the default Transport if None. A Transport is
+    returned as is.
+    '''
+    global defaultTransport
+    if isinstance(session, Transport):
+        return session
+    with transportLock:
+        if session == None:
+            if defaultTransport == None:
+                defaultTransport = Transport()
+            return defaultTransport
+        transport = sessionTransports.get(session)
+        if transport == None:
+            transport = sessionTransports[session] = Transport(session)
+        return transport
+
+def httpRequest(url, session = None, headers = None):
+    '''
+    Fetch the specified URL, with optional request headers, through the
+    Transport of the given session. Return a tuple of the HTTP status code,
+    a hash of the response headers (lowercase names), and the body.
+    '''
+    return getTransport(session).request(url, headers = headers)
+
+def httpOpen(url, session = None, headers = None):
+    '''
+    Open the specified URL for streaming, with optional request headers,
+    bypassing any cache. Return a tuple of the HTTP status code and a
+    file-like object for the body.
+    '''
+    return getTransport(session).open(url, headers = headers)
+
+class SingleFlight(object):
+    '''
+    Coalescing of concurrent calls for the same key: the first caller (the
+    leader) runs the function, and callers arriving while it is in flight wait
+    for its result, or its exception, instead of repeating the work. Waiters
+    receive a copy of a mutable result, made by the specified copy function.
+    Safe for use from multiple threads.
+    '''
+
+    class Call(object):
+        __slots__ = ('done', 'result', 'error', 'waiters')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = { }
+
+    def do(self, key, fn, copy = None):
+        '''
+        Return fn(), shared with any concurrent call for the same key.
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call == None
+            if leader:
+                call = self.calls[key] = SingleFlight.Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            metrics.count('coalesced')
+            call.done.wait()
+            if call.error != None:
+                raise call.error[0], call.error[1], call.error[2]
+            return copy(call.result) if copy != None else call.result
+        try:
+            result = fn()
+        except:
+            call.error = sys.exc_info()
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+            raise
+        # The leader may alter its result once returned, so waiters copy
+        # from a copy of their own. No waiter can join once the call is
+        # removed, so the count read with it is final.
+        with self.lock:
+            del self.calls[key]
+            waiters = call.waiters
+        call.result = copy(result) if copy != None and waiters else result
+        call.done.set()
+        return result
+
+    def inflight(self):
+        '''
+        Return the number of calls in flight.
+        '''
+        with self.lock:
+            return len(self.calls)
+
+# The SingleFlight coalescing concurrent fetches of the same URL and
+# concurrent lookups of the same game.
+singleFlight = SingleFlight()
 
 def httpGet(url, session = None):
-    if session == None:
-        return urllib.urlopen(url).read()
-    else:
-        return session.get(url).text.encode('UTF-8')
+    '''
+    Return the body of the specified URL, from the HttpCache if one is
+    installed. Concurrent requests for the same URL and session share one
+    fetch.
+    '''
+    def fetch():
+        if httpCache == None:
+            return httpRequest(url, session = session)[2]
+        return httpCache.get(url,
+            lambda url, headers: httpRequest(url, session = session, headers = headers))
+    return singleFlight.do(('url', url, session), fetch)
 
 def login(loginurl = None, username = None, password = None, configfile = None):
     config = None
@@ -192,95 +745,100 @@ def login(loginurl = None, username = None, password = None, configfile = None):
 ##    print >>sys.stderr, BeautifulSoup(httpSessionGet('http://www.boardgamegeek.com/geekbay/browse?filterwanttobuy=1&sort=endtime'), 'xml').prettify()
     return session
         
+# Field names and types of the BGG representation of a game.
+TYPEFLOAT = 0
+TYPEINT = 1
+TYPESTRING = 2
+TYPELIST = 3
+TEXTFIELDS = {
+    'age':TYPEINT,
+    'average':TYPEFLOAT,
+    'averageweight':TYPEFLOAT,
+    'bayesaverage':TYPEFLOAT,
+    'boardgameartist':TYPELIST,
+    'boardgamecategory':TYPELIST,
+    'boardgamedesigner':TYPELIST,
+    'boardgamefamily':TYPELIST,
+    'boardgamehonor':TYPELIST,
+    'boardgamemechanic':TYPELIST,
+    'boardgamepodcastepisode':TYPELIST,
+    'boardgamepublisher':TYPELIST,
+    'boardgamesubdomain':TYPELIST,
+    'boardgameversion':TYPELIST,
+    'comment':TYPESTRING,
+    'description':TYPESTRING,
+    'image':TYPESTRING,
+    'maxplayers':TYPEINT,
+    'median':TYPEFLOAT,
+    'minplayers':TYPEINT,
+    'name':TYPELIST,
+    'numcomments':TYPEINT,
+    'numweights':TYPEINT,
+    'owned':TYPEINT,
+    'playingtime':TYPEINT,
+    'stddev':TYPEFLOAT,
+    'thumbnail':TYPESTRING,
+    'trading':TYPEINT,
+    'usersrated':TYPEINT,
+    'videogamebg':TYPELIST,
+    'wanting':TYPEINT,
+    'wishing':TYPEINT,
+    'wishlistcomment':TYPESTRING,
+    'yearpublished':TYPEINT,
+}
+STATUSFIELDS = [
+    'fortrade',
+    'lastmodified',
+    'own',
+    'preordered',
+    'prevowned',
+    'want',
+    'wanttobuy',
+    'wanttoplay',
+    'wishlist',
+    'wishlistpriority',
+]
+STATSFIELDS = [
+    'maxplayers',
+    'minplayers',
+    'numowned',
+    'playingtime',
+]
+
+PRIVATEINFO = [
+    ('acquiredfrom', TYPESTRING),
+    ('acquisitiondate', TYPESTRING),
+    ('comment', TYPESTRING),
+    ('currvalue', TYPEFLOAT),
+    ('cv_currency', TYPESTRING),
+    ('numplays', TYPEINT),
+    ('originalname', TYPESTRING),
+    ('pp_currency', TYPESTRING),
+    ('pricepaid', TYPEFLOAT),
+    ('privatecomment', TYPESTRING),
+    ('privateinfo', TYPESTRING),
+    ('quantity', TYPEINT),
+    ('rating', TYPEFLOAT),
+    ('wishlistcomment', TYPESTRING),
+]
+
+# Handled ad hoc, because a mixture of attribute and text values:
+MARKETPLACE = [
+    ('listdate', TYPESTRING),
+    ('price', TYPEFLOAT), # has attribute currency
+    ('condition', TYPESTRING),
+    ('notes', TYPESTRING),
+]
+
+@timedStage('parse')
 def parseGameObject(soup):
     '''
     Parse a BeautifulSoup object containing the BGG representation of a game. Return a hash of the fields.
+    An lxml.etree element is handed to parseGameElement.
     '''
 ##    print >>sys.stderr, 'Parse target:', soup.prettify()
-    TYPEFLOAT = 0
-    TYPEINT = 1
-    TYPESTRING = 2
-    TYPELIST = 3
-    TEXTFIELDS = {
-        'age':TYPEINT,
-        'average':TYPEFLOAT,
-        'averageweight':TYPEFLOAT,
-        'bayesaverage':TYPEFLOAT,
-        'boardgameartist':TYPELIST,
-        'boardgamecategory':TYPELIST,
-        'boardgamedesigner':TYPELIST,
-        'boardgamefamily':TYPELIST,
-        'boardgamehonor':TYPELIST,
-        'boardgamemechanic':TYPELIST,
-        'boardgamepodcastepisode':TYPELIST,
-        'boardgamepublisher':TYPELIST,
-        'boardgamesubdomain':TYPELIST,
-        'boardgameversion':TYPELIST,
-        'comment':TYPESTRING,
-        'description':TYPESTRING,
-        'image':TYPESTRING,
-        'maxplayers':TYPEINT,
-        'median':TYPEFLOAT,
-        'minplayers':TYPEINT,
-        'name':TYPELIST,
-        'numcomments':TYPEINT,
-        'numweights':TYPEINT,
-        'owned':TYPEINT,
-        'playingtime':TYPEINT,
-        'stddev':TYPEFLOAT,
-        'thumbnail':TYPESTRING,
-        'trading':TYPEINT,
-        'usersrated':TYPEINT,
-        'videogamebg':TYPELIST,
-        'wanting':TYPEINT,
-        'wishing':TYPEINT,
-        'wishlistcomment':TYPESTRING,
-        'yearpublished':TYPEINT,
-    }
-    STATUSFIELDS = [
-        'fortrade',
-        'lastmodified',
-        'own',
-        'preordered',
-        'prevowned',
-        'want',
-        'wanttobuy',
-        'wanttoplay',
-        'wishlist',
-        'wishlistpriority',
-    ]
-    STATSFIELDS = [
-        'maxplayers',
-        'minplayers',
-        'numowned',
-        'playingtime',
-    ]
-
-    PRIVATEINFO = [
-        ('acquiredfrom', TYPESTRING),
-        ('acquisitiondate', TYPESTRING),
-        ('comment', TYPESTRING),
-        ('currvalue', TYPEFLOAT),
-        ('cv_currency', TYPESTRING),
-        ('numplays', TYPEINT),
-        ('originalname', TYPESTRING),
-        ('pp_currency', TYPESTRING),
-        ('pricepaid', TYPEFLOAT),
-        ('privatecomment', TYPESTRING),
-        ('privateinfo', TYPESTRING),
-        ('quantity', TYPEINT),
-        ('rating', TYPEFLOAT),
-        ('wishlistcomment', TYPESTRING),
-    ]
-
-    # Handled ad hoc, because a mixture of attribute and text values:
-    MARKETPLACE = [
-        ('listdate', TYPESTRING),
-        ('price', TYPEFLOAT), # has attribute currency
-        ('condition', TYPESTRING),
-        ('notes', TYPESTRING),
-    ]
-
+    if etree.iselement(soup):
+        return parseGameElement(soup)
     try:
         game = { }
         for rank in soup.find_all('rank'):
@@ -410,17 +968,523 @@ def parseGameObject(soup):
             print >>sys.stderr, soup.prettify()
         except:
             pass
-    return game
+    return addCommentFields(game)
+
+def elementText(e):
+    '''
+    Return the text of an lxml.etree element and its descendants, each piece
+    stripped, as BeautifulSoup's get_text('', strip=True).
+    '''
+    return u''.join([t.strip() for t in e.itertext()])
+
+def convertField(text, ftype):
+    '''
+    Convert field text to the given type. Raise ValueError if impossible.
+    '''
+    if ftype == TYPEFLOAT:
+        return float(text)
+    elif ftype == TYPEINT:
+        return int(text)
+    return text
+
+def parseRankElement(game, e):
+    try:
+        game[e.get('friendlyname').encode('ascii', 'ignore').upper().replace(' ', '')] = int(e.get('value'))
+    except (AttributeError, TypeError, ValueError):
+        pass
+
+def parseStatusElement(game, e):
+    for sf in STATUSFIELDS:
+        if e.get(sf):
+            game['STATUS_' + sf.upper()] = e.get(sf)
+
+def parseStatsElement(game, e):
+    for sf in STATSFIELDS:
+        if e.get(sf):
+            game['STATS_' + sf.upper()] = e.get(sf)
+
+def parsePrivateInfoElement(game, e):
+    for pvname, pvtype in PRIVATEINFO:
+        pv = e.find('.//' + pvname)
+        if pv == None:
+            continue
+        try:
+            game['PRIVATEINFO_' + pvname.upper()] = \
+                convertField(elementText(pv), pvtype)
+        except ValueError:
+            pass
+
+def parseListingsElement(game, e):
+    n = 0
+    for listing in e.iter('listing'):
+        n += 1
+        prefix = 'LISTING%03d_' % n
+        for mlname, mltype in MARKETPLACE:
+            ml = listing.find('.//' + mlname)
+            if ml == None:
+                continue
+            try:
+                game[prefix + mlname.upper()] = \
+                    convertField(elementText(ml), mltype)
+            except ValueError:
+                pass
+        price = listing.find('.//price')
+        if price != None:
+            game[prefix + 'PRICECURRENCY'] = price.get('currency')
+        link = listing.find('.//link')
+        if link != None:
+            game[prefix + 'LINKHREF'] = link.get('href')
+            game[prefix + 'LINKTITLE'] = link.get('title')
+
+# Parsers of the lxml.etree elements holding more than one field, by tag.
+ELEMENTPARSERS = {
+    'status':parseStatusElement,
+    'stats':parseStatsElement,
+    'privateinfo':parsePrivateInfoElement,
+    'marketplacelistings':parseListingsElement,
+}
+
+def parseGameElement(element):
+    '''
+    Parse an lxml.etree element containing the BGG representation of a game,
+    in a single pass over its descendants. Return a hash of the fields,
+    identical to that returned by parseGameObject for the same XML.
+    '''
+    game = { }
+    for tf, tftype in TEXTFIELDS.items():
+        if tftype == TYPELIST:
+            game[tf] = [ ]
+    # As with BeautifulSoup's find, only the first element of a name counts.
+    seen = set()
+    for e in element.iterdescendants():
+        tag = e.tag
+        if not isinstance(tag, basestring):
+            continue
+        if tag == 'rank':
+            parseRankElement(game, e)
+            continue
+        tftype = TEXTFIELDS.get(tag)
+        if tftype == TYPELIST:
+            game[tag].append(u''.join(e.itertext()))
+            continue
+        if tag in seen:
+            continue
+        seen.add(tag)
+        if tftype != None:
+            try:
+                game[tag] = convertField(elementText(e), tftype)
+            except ValueError:
+                pass
+        elif tag in ELEMENTPARSERS:
+            ELEMENTPARSERS[tag](game, e)
+    return addCommentFields(game)
+
+@timedStage('parsexml')
+def parseXml(xml, engine = None):
+    '''
+    Parse the specified XML with the given engine, by default PARSER_ENGINE.
+    Return a BeautifulSoup object for 'bs4', or the root lxml.etree element
+    for 'lxml'.
+    '''
+    if (engine or PARSER_ENGINE) == 'lxml':
+        return etree.fromstring(xml)
+    return BeautifulSoup(xml, 'xml')
+
+def findElements(tree, name, **attrs):
+    '''
+    Return a list of the elements of the given name, and having the given
+    attribute values, within a tree returned by parseXml.
+    '''
+    if etree.iselement(tree):
+        return [e for e in tree.iter(name)
+                if all(e.get(k) == v for k, v in attrs.items())]
+    return tree.find_all(name, **attrs)
+
+listingkey_re = re.compile(r'LISTING(\d{3})_(\w+)$')
+
+def typedValue(value):
+    '''
+    Return an attribute value as an int if it is one, else unchanged.
+    '''
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+class Record(object):
+    '''
+    Base class of the compact game records. Fields are __slots__, and a field
+    that is None is absent from the hash returned by asDict.
+    '''
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def __eq__(self, other):
+        return type(self) == type(other) and \
+            all(getattr(self, n) == getattr(other, n) for n in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(['%s=%r' % (n, getattr(self, n))
+            for n in self.__slots__ if getattr(self, n) != None]))
+
+class Rank(Record):
+    '''
+    A BGG rank. The name is the key used by parseGameObject, e.g.
+    BOARDGAMERANK.
+    '''
+    __slots__ = ('name', 'value')
+
+class Listing(Record):
+    '''
+    A BGG marketplace listing.
+    '''
+    __slots__ = ('listdate', 'price', 'pricecurrency', 'condition', 'notes',
+                 'linkhref', 'linktitle')
+
+class Status(Record):
+    '''
+    The collection status of a game. Flags are ints; lastmodified is a string.
+    '''
+    __slots__ = tuple(STATUSFIELDS)
+
+class PrivateInfo(Record):
+    '''
+    The private collection information of a game.
+    '''
+    __slots__ = tuple([name for name, type in PRIVATEINFO])
+
+class Game(Record):
+    '''
+    A compact, typed BGG game record. Fields are those of TEXTFIELDS, with
+    list fields as tuples, plus bggid, collid, title, plaindescription
+    (DESCRIPTION)
+    and the STATS_ values as stats_ fields. Status, private information,
+    ranks and marketplace listings are nested records. The WISHLISTCOMMENT_
+    values are kept in the wishlistfields hash, by lowercase name, and keys
+    not otherwise recognized in the extra hash.
+    '''
+    __slots__ = ('bggid', 'collid', 'title', 'plaindescription') + \
+        tuple(sorted(TEXTFIELDS.keys())) + \
+        tuple(['stats_' + sf for sf in STATSFIELDS]) + \
+        ('status', 'privateinfo', 'ranks', 'listings', 'wishlistfields', 'extra')
+
+    @classmethod
+    def fromDict(cls, game):
+        '''
+        Return a Game holding the fields of a hash returned by
+        parseGameObject, getGameById, getCollectionByUserAndId, etc.
+        '''
+        record = cls()
+        status = { }
+        privateinfo = { }
+        ranks = [ ]
+        listings = { }
+        wishlistfields = { }
+        extra = { }
+        for key, value in game.iteritems():
+            if key in TEXTFIELDS:
+                if TEXTFIELDS[key] == TYPELIST:
+                    value = tuple(value)
+                setattr(record, key, value)
+            elif key == 'BGGID':
+                record.bggid = value
+            elif key == 'COLLID':
+                record.collid = value
+            elif key == 'TITLE':
+                record.title = value
+            elif key == 'DESCRIPTION':
+                record.plaindescription = value
+            elif key.startswith('STATUS_'):
+                status[key[7:].lower()] = typedValue(value)
+            elif key.startswith('STATS_'):
+                setattr(record, 'stats_' + key[6:].lower(), typedValue(value))
+            elif key.startswith('PRIVATEINFO_'):
+                privateinfo[key[12:].lower()] = value
+            elif key.startswith('WISHLISTCOMMENT_'):
+                wishlistfields[key[16:].lower()] = value
+            elif listingkey_re.match(key):
+                m = listingkey_re.match(key)
+                listings.setdefault(int(m.group(1)), { })[m.group(2).lower()] = value
+            elif key.isupper() and type(value) == int:
+                ranks.append(Rank(name=key, value=value))
+            else:
+                extra[key] = value
+        if status:
+            record.status = Status(**status)
+        if privateinfo:
+            record.privateinfo = PrivateInfo(**privateinfo)
+        if ranks:
+            record.ranks = tuple(sorted(ranks, key=lambda r: r.name))
+        if listings:
+            record.listings = tuple([Listing(**listings[n]) for n in sorted(listings)])
+        if wishlistfields:
+            record.wishlistfields = wishlistfields
+        if extra:
+            record.extra = extra
+        return record
+
+    def rank(self, name = 'BOARDGAMERANK'):
+        '''
+        Return the value of the named rank, or None.
+        '''
+        for rank in self.ranks or ():
+            if rank.name == name:
+                return rank.value
+        return None
+
+    def asDict(self):
+        '''
+        Return a hash with the keys and values that parseGameObject and the
+        fetch functions produce.
+        '''
+        game = { }
+        for tf in TEXTFIELDS:
+            value = getattr(self, tf)
+            if value != None:
+                game[tf] = list(value) if TEXTFIELDS[tf] == TYPELIST else value
+        if self.bggid != None:
+            game['BGGID'] = self.bggid
+        if self.collid != None:
+            game['COLLID'] = self.collid
+        if self.title != None:
+            game['TITLE'] = self.title
+        if self.plaindescription != None:
+            game['DESCRIPTION'] = self.plaindescription
+        for sf in STATSFIELDS:
+            value = getattr(self, 'stats_' + sf)
+            if value != None:
+                game['STATS_' + sf.upper()] = unicode(value)
+        if self.status:
+            for sf in STATUSFIELDS:
+                value = getattr(self.status, sf)
+                if value != None:
+                    game['STATUS_' + sf.upper()] = unicode(value)
+        if self.privateinfo:
+            for pvname, pvtype in PRIVATEINFO:
+                value = getattr(self.privateinfo, pvname)
+                if value != None:
+                    game['PRIVATEINFO_' + pvname.upper()] = value
+        for rank in self.ranks or ():
+            game[rank.name] = rank.value
+        for n, listing in enumerate(self.listings or ()):
+            for name in Listing.__slots__:
+                value = getattr(listing, name)
+                if value != None:
+                    game['LISTING%03d_' % (n + 1) + name.upper()] = value
+        for name, value in (self.wishlistfields or { }).iteritems():
+            game['WISHLISTCOMMENT_' + name.upper()] = value
+        if self.extra:
+            game.update(self.extra)
+        return game
+
+# List fields exported by toColumns as categorical indicator matrices.
+CATEGORICALFIELDS = [
+    'boardgamecategory',
+    'boardgamemechanic',
+]
+
+def columnType(key, value):
+    '''
+    Return TYPEINT or TYPEFLOAT if toColumns exports the key of a game hash as
+    a numeric column, else None.
+    '''
+    if key in TEXTFIELDS:
+        return TEXTFIELDS[key] if TEXTFIELDS[key] in [TYPEINT, TYPEFLOAT] else None
+    if key.startswith('STATS_'):
+        return TYPEINT
+    if key.startswith('STATUS_'):
+        return TYPEINT if key != 'STATUS_LASTMODIFIED' else None
+    if key.startswith('PRIVATEINFO_'):
+        ftype = dict(PRIVATEINFO).get(key[12:].lower())
+        return ftype if ftype in [TYPEINT, TYPEFLOAT] else None
+    if key == 'WISHLISTCOMMENT_WTB':
+        return TYPEFLOAT # the target price
+    if key in ['BGGID', 'COLLID'] or listingkey_re.match(key):
+        return None
+    if key.isupper() and type(value) == int:
+        return TYPEINT # a rank
+    return None
+
+def toColumns(games, categorical = CATEGORICALFIELDS):
+    '''
+    Return a columnar form of a list of game hashes or Game records, for
+    vectorized filtering, sorting and statistics. Requires numpy.
+
+    The hash returned has:
+    - bggid: an int array.
+    - title: an object array.
+    - For each numeric field present in any game (average, usersrated,
+      BOARDGAMERANK, STATS_NUMOWNED, PRIVATEINFO_RATING, STATUS_OWN, etc.):
+      a numpy.ma masked array, float or int, masked where the game lacks the
+      field or its value is not a number.
+    - For each categorical list field, e.g. boardgamemechanic: a boolean
+      matrix with a row per game and a column per category, and, with the
+      suffix _categories, an object array of the category names. A column
+      index is the code of a category.
+
+    E.g., the average rating of games with the Trading mechanic:
+      columns = toColumns(games)
+      trading = list(columns['boardgamemechanic_categories']).index('Trading')
+      columns['average'][columns['boardgamemechanic'][:, trading]].mean()
+    '''
+    import numpy
+    games = [g.asDict() if isinstance(g, Record) else g for g in games]
+    n = len(games)
+    ftypes = { }
+    for game in games:
+        for key, value in game.iteritems():
+            if key not in ftypes:
+                ftype = columnType(key, value)
+                if ftype != None:
+                    ftypes[key] = ftype
+    columns = {
+        'bggid':numpy.array([int(g.get('BGGID', 0)) for g in games], dtype=numpy.int64),
+        'title':numpy.array([g.get('TITLE') for g in games], dtype=object),
+    }
+    for key, ftype in ftypes.iteritems():
+        convert, dtype = (int, numpy.int64) if ftype == TYPEINT else (float, numpy.float64)
+        data = numpy.zeros(n, dtype=dtype)
+        mask = numpy.ones(n, dtype=bool)
+        for i, game in enumerate(games):
+            try:
+                data[i] = convert(game[key])
+                mask[i] = False
+            except (KeyError, TypeError, ValueError):
+                pass
+        columns[key] = numpy.ma.MaskedArray(data, mask=mask)
+    for field in categorical:
+        categories = sorted(set(c for g in games for c in g.get(field, [])))
+        codes = dict((c, i) for i, c in enumerate(categories))
+        matrix = numpy.zeros((n, len(categories)), dtype=bool)
+        for i, game in enumerate(games):
+            for c in game.get(field, []):
+                matrix[i, codes[c]] = True
+        columns[field] = matrix
+        columns[field + '_categories'] = numpy.array(categories, dtype=object)
+    return columns
+
+# The columns of the JSON Lines and CSV exports, in order. Ranks, marketplace
+# listings, wishlist comment fields and keys not otherwise recognized are
+# folded into RANKS, LISTINGS, WISHLISTCOMMENT and EXTRA, so that the columns
+# do not depend on the games exported.
+EXPORTCOLUMNS = ['BGGID', 'COLLID', 'TITLE', 'DESCRIPTION'] + \
+    sorted(TEXTFIELDS.keys()) + \
+    ['STATS_' + sf.upper() for sf in STATSFIELDS] + \
+    ['STATUS_' + sf.upper() for sf in STATUSFIELDS] + \
+    ['PRIVATEINFO_' + pvname.upper() for pvname, pvtype in PRIVATEINFO] + \
+    ['RANKS', 'LISTINGS', 'WISHLISTCOMMENT', 'EXTRA']
+
+def exportRecord(game):
+    '''
+    Return an ordered hash of the EXPORTCOLUMNS of a game hash or Game record.
+    A missing field is None. RANKS is a hash of rank name to value; LISTINGS
+    is a list of hashes of listdate, price, pricecurrency, condition, notes,
+    linkhref and linktitle; WISHLISTCOMMENT is a hash of the WISHLISTCOMMENT_
+    values, by lowercase name; EXTRA is a hash of any other keys.
+    '''
+    if isinstance(game, Record):
+        game = game.asDict()
+    record = collections.OrderedDict((column, None) for column in EXPORTCOLUMNS)
+    ranks = { }
+    listings = { }
+    wishlistfields = { }
+    extra = { }
+    for key, value in game.iteritems():
+        if key in record:
+            record[key] = value
+        elif key.startswith('WISHLISTCOMMENT_'):
+            wishlistfields[key[16:].lower()] = value
+        elif listingkey_re.match(key):
+            m = listingkey_re.match(key)
+            listings.setdefault(int(m.group(1)), { })[m.group(2).lower()] = value
+        elif key.isupper() and type(value) == int:
+            ranks[key] = value
+        else:
+            extra[key] = value
+    record['RANKS'] = ranks
+    record['LISTINGS'] = [listings[n] for n in sorted(listings)]
+    record['WISHLISTCOMMENT'] = wishlistfields
+    record['EXTRA'] = extra
+    return record
+
+class JsonLinesWriter(object):
+    '''
+    Write games to a file as JSON Lines: one JSON object per game, with the
+    keys of exportRecord.
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write(self, game):
+        self.f.write(json.dumps(exportRecord(game)) + '\n')
+        self.count += 1
+
+    def writeAll(self, games):
+        for game in games:
+            self.write(game)
+        return self.count
+
+class CsvWriter(object):
+    '''
+    Write games to a file as CSV, UTF-8 encoded, with a header row of
+    EXPORTCOLUMNS. List fields (e.g., name, boardgamedesigner), RANKS,
+    LISTINGS and EXTRA are written as JSON text, because their values may
+    contain any separator.
+    '''
+
+    def __init__(self, f):
+        self.writer = csv.writer(f)
+        self.count = 0
+        self.writer.writerow(EXPORTCOLUMNS)
+
+    def cell(self, value):
+        if value == None:
+            return ''
+        if type(value) in [list, dict]:
+            return json.dumps(value)
+        if type(value) == unicode:
+            return value.encode('utf-8')
+        return value
+
+    def write(self, game):
+        self.writer.writerow([self.cell(v) for v in exportRecord(game).itervalues()])
+        self.count += 1
+
+    def writeAll(self, games):
+        for game in games:
+            self.write(game)
+        return self.count
+
+EXPORTWRITERS = {
+    'jsonl':JsonLinesWriter,
+    'csv':CsvWriter,
+}
+
+def exportGames(games, f, format = 'jsonl'):
+    '''
+    Write games, from a list or generator of game hashes or Game records
+    (e.g., iterEnrichCollection), to a file as 'jsonl' or 'csv', one game at
+    a time. Return the number of games written.
+    '''
+    return EXPORTWRITERS[format](f).writeAll(games)
 
 def getElementsAndAttributes(session = None):
     structure = { }
-    URL = 'http://www.boardgamegeek.com/xmlapi/collection/wbmccarty'
+    URL = BGG_URL + '/xmlapi/collection/wbmccarty'
     soup = BeautifulSoup(httpGet(URL, session = session), 'xml')
 ##    print soup.prettify()
     # root element: items
     e = soup.find('items')
     while e:
-        if type(e) == element.Tag and e.name != 'items' and e.name != 'item':
+        if type(e) == bs4.element.Tag and e.name != 'items' and e.name != 'item':
 ##            print >>sys.stderr, 'e tag:', 'name=', e.name, 'attrs=', e.attrs
             if e.name not in structure:
                 structure[e.name] = True
@@ -431,12 +1495,12 @@ def getElementsAndAttributes(session = None):
                     print >>sys.stderr, e.name + '.' + attr, e.get(attr)
         e = e.next_element
     print >>sys.stderr, 'structure after collection:', structure
-    URL = 'http://www.boardgamegeek.com/xmlapi/boardgame/12333?stats=1'
+    URL = BGG_URL + '/xmlapi/boardgame/12333?stats=1'
     soup = BeautifulSoup(httpGet(URL, session))
     # root element: boardgames
     e = soup.find('boardgames')
     while e:
-        if type(e) == element.Tag and e.name != 'boardgames' and e.name != 'boardgame':
+        if type(e) == bs4.element.Tag and e.name != 'boardgames' and e.name != 'boardgame':
 ##            print >>sys.stderr, 'e tag:', 'name=', e.name, 'attrs=', e.attrs
             if e.name not in structure:
                 structure[e.name] = True
@@ -454,10 +1518,7 @@ def prettyPrintCollectionByUserAndId(user, id, session = None):
     Pretty print from the specified user's collection all game records
     specified by the given BGG ID.
     '''
-    URL = 'http://www.boardgamegeek.com/xmlapi/collection/%s'
-    url = URL % user
-    soup = BeautifulSoup(httpGet(url, session = session), 'xml')
-    collection = [ ]
+    soup = BeautifulSoup(getCollectionXml(user, session = session), 'xml')
     for item in soup.find_all('item', objectid=str(id)):
         print item.prettify()
         print
@@ -466,229 +1527,1322 @@ def prettyPrintGameById(id, session = None):
     '''
     Pretty print the game record specified by the given BGG ID.
     '''
-    URL = 'http://www.boardgamegeek.com/xmlapi/boardgame/%d?stats=1'
+    URL = BGG_URL + '/xmlapi/boardgame/%d?stats=1'
     url = URL % int(id)
     soup = BeautifulSoup(httpGet(url, session = session), 'xml')
     print soup.prettify()
     print
 
-def getCollectionByUserAndId(user, id=0, session = None):
-    URL = 'http://www.boardgamegeek.com/xmlapi/collection/%s'
-    url = URL % user
-    soup = BeautifulSoup(httpGet(url, session = session), 'xml')
-    collection = [ ]
-    if id == 0:
-        items = soup.find_all('item')
+def parseCollectionItem(item):
+    '''
+    Parse a BeautifulSoup or lxml.etree item element from a BGG collection.
+    Return a hash of the fields.
+    '''
+    game = parseGameObject(item)
+    if etree.iselement(item):
+        game['TITLE'] = elementText(item.find('.//name'))
     else:
-        items = soup.find_all('item', objectid=str(id))
-    for item in items:
-##        print >>sys.stderr, 'item:', item.prettify()
-        game = parseGameObject(item)
         game['TITLE'] = item.find('name').get_text('', strip=True)
-        game['BGGID'] = int(item.get('objectid'))
-        game2 = getGameById(game['BGGID'],session = session)
-        for key in game.keys():
-            game2[key] = game[key]
-        collection.append(game2)
-    return collection
+    game['BGGID'] = int(item.get('objectid'))
+    if item.get('collid'):
+        game['COLLID'] = int(item.get('collid'))
+    return game
+
+def mergeCollection(collection, games):
+    '''
+    Merge each parsed collection item with the game record, from the given
+    list, or hash by BGG ID, having its BGG ID. Collection fields take
+    precedence, except empty list fields (e.g. boardgamemechanic), which
+    collection items always have. Return a list of the merged hashes, each a
+    shallow copy of the game record.
+    '''
+    if isinstance(games, dict):
+        byid = games
+    else:
+        byid = { }
+        for game in games:
+            byid[game['BGGID']] = game
+    merged = [ ]
+    for item in collection:
+        game = dict(byid.get(item['BGGID'], { }))
+        for key, value in item.iteritems():
+            if value != [ ] or key not in game:
+                game[key] = value
+        merged.append(game)
+    return merged
+
+@timedStage('enrich')
+def enrichCollection(collection, session = None, batch_size = GAMES_BATCH_SIZE,
+                     engine = None):
+    '''
+    Merge each parsed collection item with the full game record for its BGG
+    ID, fetched in batches. Collection fields take precedence. Return a list
+    of the merged hashes.
+    '''
+    games = getGamesByIds([item['BGGID'] for item in collection],
+                          batch_size = batch_size, session = session,
+                          engine = engine)
+    return mergeCollection(collection, games)
+
+def parseCollection(xml, id=0, engine = None):
+    '''
+    Parse the XML of a BGG collection with the given engine. Return a list of
+    hashes, one per item, or only for items having the given BGG ID if
+    nonzero. Raise an exception if the XML is not a collection, e.g. BGG's
+    errors document for an invalid user, rather than return no items.
+    '''
+    tree = parseXml(xml, engine)
+    if etree.iselement(tree):
+        root, text = tree.tag, elementText(tree)
+    else:
+        root = tree.find(True)
+        root, text = root and root.name, root and root.get_text('', strip=True)
+    if root != 'items':
+        raise Exception('Collection request failed: %s' % text)
+    if id == 0:
+        items = findElements(tree, 'item')
+    else:
+        items = findElements(tree, 'item', objectid=str(id))
+    return [parseCollectionItem(item) for item in items]
+
+def getCollectionByUserAndId(user, id=0, session = None, engine = None):
+    collection = parseCollection(getCollectionXml(user, session = session),
+                                 id, engine)
+    return enrichCollection(collection, session = session, engine = engine)
+
+def getCollectionsByUsers(users, id=0, session = None, engine = None,
+                          batch_size = GAMES_BATCH_SIZE, client = None):
+    '''
+    Return a hash, by user name, of the collections of the specified users,
+    as getCollectionByUserAndId. The collections are requested together, so
+    that BGG can process queued requests in parallel; the game records of
+    the distinct BGG IDs of all of them are then fetched once, by
+    getGamesByIds or, if given, a ConcurrentClient, and shared: each user's
+    items are merged onto shallow copies. A collection BGG did not process
+    in time, or answered with an error, is None.
+    '''
+    scheduler = CollectionScheduler(session = session)
+    for user in set(users):
+        scheduler.submit(user)
+    collections = { }
+    for user, xml in scheduler.drain():
+        collections[user] = None
+        if xml != None:
+            try:
+                collections[user] = parseCollection(xml, id, engine)
+            except Exception as e:
+                print >>sys.stderr, 'Collection of %s:' % user, e
+    ids = [item['BGGID'] for collection in collections.values() if collection
+           for item in collection]
+    if client != None:
+        games = client.getGames(ids)
+    else:
+        games = getGamesByIds(ids, batch_size = batch_size, session = session,
+                              engine = engine)
+    byid = dict((game['BGGID'], game) for game in games)
+    for user, collection in collections.items():
+        if collection != None:
+            collections[user] = mergeCollection(collection, byid)
+    return collections
+
+def collectionUrl(user, params = None):
+    '''
+    Return the collection XML API URL for the specified user, with an
+    optional hash of query parameters.
+    '''
+    URL = BGG_URL + '/xmlapi/collection/%s'
+    url = URL % urllib.quote(user)
+    if params:
+        url += '?' + '&'.join(['%s=%s' % (k, urllib.quote(str(v)))
+                               for k, v in sorted(params.items())])
+    return url
+
+def isQueued(xml):
+    '''
+    Return True if the specified response is BGG's placeholder for a queued
+    collection request, rather than a collection.
+    '''
+    return queued_re.search(xml[:1024]) != None
+
+class CollectionScheduler(object):
+    '''
+    Fetch collections that BGG may queue for processing. A queued request is
+    re-polled with exponential backoff and random jitter, while the other
+    requests proceed, so that many collections can be queued server-side at
+    once and collected as they become ready.
+
+    Use submit to add requests, then either drain to wait for them all, or
+    poll and nextDue to interleave the waits with other work.
+    '''
+
+    def __init__(self, session = None, backoff = POLL_BACKOFF,
+                 max_backoff = POLL_MAX_BACKOFF, jitter = POLL_JITTER,
+                 timeout = POLL_TIMEOUT):
+        self.session = session
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.timeout = timeout
+        self.seq = 0
+        # Entries: (due time, sequence, key, url, attempt, submit time)
+        self.heap = [ ]
+
+    def submit(self, key, url = None):
+        '''
+        Schedule the collection request for the specified key, by default the
+        collection of the user named by the key.
+        '''
+        if url == None:
+            url = collectionUrl(key)
+        now = time.time()
+        self.push((now, key, url, 0, now))
+
+    def push(self, entry):
+        due, key, url, attempt, started = entry
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, key, url, attempt, started))
+
+    def delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * (1.0 + random.uniform(-self.jitter, self.jitter))
+
+    def pending(self):
+        return len(self.heap)
+
+    def nextDue(self):
+        '''
+        Return the number of seconds until the next request is due, or None
+        if there are none.
+        '''
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.time())
+
+    def poll(self):
+        '''
+        Issue every request now due, without waiting. Return a list of
+        (key, xml) pairs for the collections that are ready. A request still
+        queued after timeout seconds is abandoned and reported with xml None.
+        '''
+        ready = [ ]
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            due, seq, key, url, attempt, started = heapq.heappop(self.heap)
+            xml = httpGet(url, session = self.session)
+            now = time.time()
+            if not isQueued(xml):
+                ready.append((key, xml))
+            elif now - started > self.timeout:
+                print >>sys.stderr, 'Timed out waiting for queued collection:', url
+                ready.append((key, None))
+            else:
+                self.push((now + self.delay(attempt), key, url, attempt + 1, started))
+        return ready
+
+    def drain(self):
+        '''
+        Generate (key, xml) pairs, in order of readiness, until all submitted
+        requests are complete.
+        '''
+        while self.heap:
+            wait = self.nextDue()
+            if wait > 0:
+                time.sleep(wait)
+            for key, xml in self.poll():
+                yield key, xml
+
+def getCollectionXml(user, session = None, params = None):
+    '''
+    Return the collection XML of the specified user, waiting for BGG to
+    process the request if it is queued.
+    '''
+    scheduler = CollectionScheduler(session = session)
+    scheduler.submit(user, collectionUrl(user, params))
+    for key, xml in scheduler.drain():
+        if xml == None:
+            raise Exception('Collection request for %s was not processed.' % user)
+        return xml
 
 def prettyPrintWishlistByUserId(userid, session = None):
     '''
     Pretty print the game record specified by the given BGG ID.
     '''
-    URL = 'http://www.boardgamegeek.com/recentadditions/rss?subdomain=&colfilters%%5B0%%5D=wishlist&infilters%%5B0%%5D=storeitem&domain=boardgame&userid=%d'
+    URL = BGG_URL + '/recentadditions/rss?subdomain=&colfilters%%5B0%%5D=wishlist&infilters%%5B0%%5D=storeitem&domain=boardgame&userid=%d'
     url = URL % int(userid)
     soup = BeautifulSoup(httpGet(url, session = session), 'xml')
     print soup.prettify()
     print
 
-##def getWishlistByUserId(userid, session = None):
-##    '''
-##    Return a hash containing the fields of the specified BGG game record.
-##    '''
-##    URL = 'http://www.boardgamegeek.com/xmlapi/boardgame/%d&marketplace=1'
-##    url = URL % int(id)
-##    soup = BeautifulSoup(httpGet(url, session = session), 'xml')
-##    game = parseGameObject(soup)
-##    game['TITLE'] = soup.find('name', primary='true').get_text('', strip=True)
-##    game['BGGID'] = int(soup.find('boardgame').get('objectid'))
-##    if 'description' in game:
-####        print >>sys.stderr, 'found description'
-##        game['DESCRIPTION'] = unicode(lxml.html.fromstring(game['description']).text_content())
-####        print >>sys.stderr, game['description']
-####        print >>sys.stderr, game['DESCRIPTION']
-##    return game
+# Fields of the HTML description of a wishlist RSS item.
+wishlist_seller_re = re.compile(r"""/user/([^'"]+)['"]""")
+wishlist_price_re = re.compile(r'itemid=\d+"\s*>([^<\d]*)([\d,]+(?:\.\d+)?)</a>')
+wishlist_game_re = re.compile(r'/boardgame/(\d+)/[^"]*"\s*>([^<]*)</a>')
+wishlist_field_re = re.compile(r'(Condition|Location):\s*([^<\n]*)')
+
+# The number of most recent wishlist RSS guids kept by getWishlistByUserId.
+WISHLIST_GUIDS = 500
+
+class WishlistOffer(Record):
+    '''
+    A marketplace offer of a game on a user's wishlist, from the wishlist
+    RSS feed. price is a float, in currency (e.g., '$'); pubdate is as in the
+    feed, e.g. 'Sun, 29 Sep 2013 03:09:27 +0000'.
+    '''
+    __slots__ = ('guid', 'itemid', 'title', 'bggid', 'gametitle', 'seller', 'price',
+                 'currency', 'condition', 'location', 'link', 'pubdate', 'creator')
+
+def parseWishlistItem(item):
+    '''
+    Parse an lxml.etree item element of the wishlist RSS feed. Return a
+    WishlistOffer.
+    '''
+    fields = { }
+    for e in item:
+        if isinstance(e.tag, basestring):
+            fields[etree.QName(e).localname] = (e.text or '').strip()
+    description = fields.get('description', '')
+    offer = WishlistOffer(guid=fields.get('guid'), title=fields.get('title'),
+                          link=fields.get('link'), pubdate=fields.get('pubDate'),
+                          creator=fields.get('creator'))
+    m = auction_re.search(offer.guid or '')
+    if m:
+        offer.itemid = int(m.group(1))
+    m = wishlist_seller_re.search(description)
+    if m:
+        offer.seller = m.group(1)
+    m = wishlist_price_re.search(description)
+    if m:
+        offer.currency = m.group(1).strip()
+        offer.price = float(m.group(2).replace(',', ''))
+    m = wishlist_game_re.search(description)
+    if m:
+        offer.bggid = int(m.group(1))
+        offer.gametitle = m.group(2).strip()
+    for name, value in wishlist_field_re.findall(description):
+        setattr(offer, name.lower(), value.strip())
+    return offer
+
+def iterWishlist(f, seen = ()):
+    '''
+    Generate a WishlistOffer for each item of the wishlist RSS in a
+    file-like object, newest first, while streaming it, and stop at the
+    first item whose guid is in seen.
+    '''
+    for event, item in etree.iterparse(f, events=('end',), tag='item'):
+        offer = parseWishlistItem(item)
+        if offer.guid in seen:
+            return
+        yield offer
+        item.clear()
+        while item.getprevious() != None:
+            del item.getparent()[0]
+
+def getWishlistByUserId(userid, session = None, state = None):
+    '''
+    Generate a WishlistOffer for each recent marketplace offer of a game on
+    the wishlist of the specified user, newest first.
+
+    For incremental polling, pass the same state hash, initially empty, on
+    each call, and save it (as JSON) between runs. The request is then
+    conditional on the validators of the last response, so an unchanged feed
+    costs a 304 and no parsing, and the feed is read only as far as the
+    first offer already generated. The guids of the offers generated and the
+    validators are kept only once the feed is read to its end, or to an
+    offer already generated: if reading fails, or the caller stops early,
+    the next call generates the same offers again rather than skip them.
+    '''
+    URL = BGG_URL + '/recentadditions/rss?subdomain=&colfilters%%5B0%%5D=wishlist&infilters%%5B0%%5D=storeitem&domain=boardgame&userid=%d'
+    url = URL % int(userid)
+    if state == None:
+        state = { }
+    headers = { }
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('lastmodified'):
+        headers['If-Modified-Since'] = state['lastmodified']
+    status, f = httpOpen(url, session = session, headers = headers)
+    guids = [ ]
+    try:
+        if status == 304:
+            return
+        if status != 200:
+            raise Exception('Wishlist request for %d failed: HTTP %d' % (int(userid), status))
+        for offer in iterWishlist(f, set(state.get('guids', [ ]))):
+            guids.append(offer.guid)
+            yield offer
+        state['guids'] = (guids + state.get('guids', [ ]))[:WISHLIST_GUIDS]
+        state['etag'] = f.getheader('etag')
+        state['lastmodified'] = f.getheader('last-modified')
+    finally:
+        f.close()
 
 
 def prettyPrintMarketplaceById(id, session = None):
     '''
     Pretty print the game record specified by the given BGG ID.
     '''
-    URL = 'http://www.boardgamegeek.com/xmlapi/boardgame/%d&marketplace=1'
+    URL = BGG_URL + '/xmlapi/boardgame/%d&marketplace=1'
     url = URL % int(id)
     soup = BeautifulSoup(httpGet(url, session = session), 'xml')
     print soup.prettify()
     print
 
 
-def getMarketplaceById(id, session = None):
+def parseBoardgame(boardgame):
     '''
-    Return a hash containing the fields of the specified BGG game record.
+    Parse a BeautifulSoup or lxml.etree boardgame element from the BGG
+    boardgame XML API. Return a hash of the fields.
     '''
-    URL = 'http://www.boardgamegeek.com/xmlapi/boardgame/%d&marketplace=1'
-    url = URL % int(id)
-    soup = BeautifulSoup(httpGet(url, session = session), 'xml')
-    game = parseGameObject(soup)
-    game['TITLE'] = soup.find('name', primary='true').get_text('', strip=True)
-    game['BGGID'] = int(soup.find('boardgame').get('objectid'))
+    game = parseGameObject(boardgame)
+    if etree.iselement(boardgame):
+        game['TITLE'] = elementText(boardgame.find('.//name[@primary="true"]'))
+    else:
+        game['TITLE'] = boardgame.find('name', primary='true').get_text('', strip=True)
+    game['BGGID'] = int(boardgame.get('objectid'))
     if 'description' in game:
 ##        print >>sys.stderr, 'found description'
-        game['DESCRIPTION'] = unicode(lxml.html.fromstring(game['description']).text_content())
+        with metrics.timer('description'):
+            game['DESCRIPTION'] = unicode(lxml.html.fromstring(game['description']).text_content())
 ##        print >>sys.stderr, game['description']
 ##        print >>sys.stderr, game['DESCRIPTION']
     return game
 
+class LazyGame(collections.MutableMapping):
+    '''
+    A game hash, with the keys of parseBoardgame, that holds the lxml.etree
+    boardgame element and parses each field on first access, caching it.
+    Fields are loaded by section: a text field by itself; ranks, status,
+    stats, private information, marketplace listings and wishlist comment
+    fields each as a group. DESCRIPTION, the description with its HTML
+    stripped, is computed only when read. Listing the keys, e.g. by
+    iteration or len, parses all fields but DESCRIPTION in one pass.
+
+    A LazyGame keeps the whole document of its element in memory; use
+    dict(game) for a plain copy.
+    '''
+    __slots__ = ('element', 'fields', 'loaded')
+
+    def __init__(self, element):
+        self.element = element
+        self.fields = { }
+        self.loaded = set()
+
+    def section(self, key):
+        '''
+        Return the name of the section holding the specified key.
+        '''
+        if key in ['TITLE', 'BGGID', 'DESCRIPTION'] or key in TEXTFIELDS:
+            return key
+        for prefix, section in [('STATUS_', 'status'), ('STATS_', 'stats'),
+                                ('PRIVATEINFO_', 'privateinfo'),
+                                ('WISHLISTCOMMENT_', 'commentfields')]:
+            if key.startswith(prefix):
+                return section
+        if listingkey_re.match(key):
+            return 'marketplacelistings'
+        if key.isupper():
+            return 'rank'
+        return None
+
+    def merge(self, fields):
+        # A value already set, e.g. by assignment, takes precedence.
+        for key, value in fields.iteritems():
+            self.fields.setdefault(key, value)
+
+    def load(self, section):
+        if section == None or section in self.loaded or \
+           ('all' in self.loaded and section != 'DESCRIPTION'):
+            return
+        self.loaded.add(section)
+        element = self.element
+        fields = { }
+        if section == 'TITLE':
+            fields['TITLE'] = elementText(element.find('.//name[@primary="true"]'))
+        elif section == 'BGGID':
+            fields['BGGID'] = int(element.get('objectid'))
+        elif section == 'DESCRIPTION':
+            if 'description' in self:
+                with metrics.timer('description'):
+                    fields['DESCRIPTION'] = unicode(lxml.html.fromstring(self['description']).text_content())
+        elif section in TEXTFIELDS:
+            if TEXTFIELDS[section] == TYPELIST:
+                fields[section] = [u''.join(e.itertext()) for e in element.iterdescendants(section)]
+            else:
+                e = next(element.iterdescendants(section), None)
+                if e != None:
+                    try:
+                        fields[section] = convertField(elementText(e), TEXTFIELDS[section])
+                    except ValueError:
+                        pass
+        elif section == 'rank':
+            for e in element.iterdescendants('rank'):
+                parseRankElement(fields, e)
+        elif section == 'commentfields':
+            for key in ['wishlistcomment', 'PRIVATEINFO_WISHLISTCOMMENT']:
+                if key in self:
+                    fields[key] = self[key]
+            addCommentFields(fields)
+        else:
+            e = next(element.iterdescendants(section), None)
+            if e != None:
+                ELEMENTPARSERS[section](fields, e)
+        self.merge(fields)
+
+    def loadAll(self):
+        '''
+        Parse all fields but DESCRIPTION, in one pass.
+        '''
+        if 'all' in self.loaded:
+            return
+        fields = parseGameElement(self.element)
+        fields['TITLE'] = elementText(self.element.find('.//name[@primary="true"]'))
+        fields['BGGID'] = int(self.element.get('objectid'))
+        self.merge(fields)
+        self.loaded.add('all')
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            if key == 'DESCRIPTION':
+                self.load(key)
+            else:
+                self.load(self.section(key))
+        return self.fields[key]
+
+    def __setitem__(self, key, value):
+        self.fields[key] = value
+
+    def __delitem__(self, key):
+        self.loadAll()
+        if key == 'DESCRIPTION':
+            self[key]
+        del self.fields[key]
+        self.loaded.add(key)
+
+    def keys(self):
+        self.loadAll()
+        keys = self.fields.keys()
+        if 'DESCRIPTION' not in self.loaded and 'description' in self.fields \
+           and 'DESCRIPTION' not in self.fields:
+            keys.append('DESCRIPTION')
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
 
+    def __repr__(self):
+        return 'LazyGame(%s)' % self.element.get('objectid')
 
-def getGameById(id, session = None):
+def boardgameRecord(boardgame, lazy):
+    '''
+    Return a LazyGame of an lxml.etree boardgame element if lazy, else the
+    hash returned by parseBoardgame.
+    '''
+    metrics.count('games')
+    if lazy:
+        return LazyGame(boardgame)
+    return parseBoardgame(boardgame)
+
+def getMarketplaceById(id, session = None, engine = None, lazy = False):
     '''
     Return a hash containing the fields of the specified BGG game record.
+    If lazy, return a LazyGame, parsed with lxml regardless of the engine.
     '''
-    URL = 'http://www.boardgamegeek.com/xmlapi/boardgame/%d?stats=1'
+    URL = BGG_URL + '/xmlapi/boardgame/%d&marketplace=1'
     url = URL % int(id)
-    soup = BeautifulSoup(httpGet(url, session = session), 'xml')
-    game = parseGameObject(soup)
-    game['TITLE'] = soup.find('name', primary='true').get_text('', strip=True)
-    game['BGGID'] = int(soup.find('boardgame').get('objectid'))
-    if 'description' in game:
-##        print >>sys.stderr, 'found description'
-        game['DESCRIPTION'] = unicode(lxml.html.fromstring(game['description']).text_content())
-##        print >>sys.stderr, game['description']
-##        print >>sys.stderr, game['DESCRIPTION']
-    return game
+    tree = parseXml(httpGet(url, session = session), 'lxml' if lazy else engine)
+    return boardgameRecord(findElements(tree, 'boardgame')[0], lazy)
 
 
 
-if __name__ == '__main__':
+def getGameById(id, session = None, engine = None, lazy = False):
+    '''
+    Return a hash containing the fields of the specified BGG game record.
+    If lazy, return a LazyGame, parsed with lxml regardless of the engine.
+    Concurrent lookups of the same game share one fetch and parse; each
+    caller receives its own copy of the record.
+    '''
+    URL = BGG_URL + '/xmlapi/boardgame/%d?stats=1'
+    url = URL % int(id)
+    def lookup():
+        tree = parseXml(httpGet(url, session = session), 'lxml' if lazy else engine)
+        return boardgameRecord(findElements(tree, 'boardgame')[0], lazy)
+    return singleFlight.do(('game', int(id), engine, lazy, session), lookup,
+                           copy = copy.deepcopy)
 
-    session = login()
+def uniqueIds(ids):
+    '''
+    Return the specified BGG IDs as a list of ints, without duplicates, in
+    order of first appearance.
+    '''
+    unique = [ ]
+    seen = set()
+    for id in ids:
+        id = int(id)
+        if id not in seen:
+            seen.add(id)
+            unique.append(id)
+    return unique
+
+def getGamesByIds(ids, batch_size = GAMES_BATCH_SIZE, session = None,
+                  engine = None, lazy = False):
+    '''
+    Return a list of hashes containing the fields of the specified BGG game
+    records. The boardgame XML API accepts a comma-separated list of IDs, so
+    the records are requested batch_size at a time rather than one per ID.
+    Duplicate IDs are fetched once; IDs unknown to BGG are omitted. The
+    engine selects the XML parser, as for parseXml. If lazy, return
+    LazyGames, parsed with lxml regardless of the engine.
+    '''
+    URL = BGG_URL + '/xmlapi/boardgame/%s?stats=1'
+    unique = uniqueIds(ids)
+    games = [ ]
+    for i in range(0, len(unique), batch_size):
+        url = URL % ','.join(['%d' % id for id in unique[i:i + batch_size]])
+        tree = parseXml(httpGet(url, session = session), 'lxml' if lazy else engine)
+        for boardgame in findElements(tree, 'boardgame'):
+            if boardgame.get('objectid') == None or findElements(boardgame, 'error'):
+                continue
+            games.append(boardgameRecord(boardgame, lazy))
+    return games
 
-    userid = 696454
-    prettyPrintWishlistByUserId(userid, session = session)
-    sys.exit(0)
 
-    id = 111
-    prettyPrintMarketplaceById(id, session = session)
-    try:
-        game = getMarketplaceById(id, session = session)
-        print 
-        for key in sorted(game.keys(), key=str.lower):
-            if type(game[key]) is list:
-                for v in game[key]:
-                    print '%s: %s' % (key, v)
-            else:    
-                print '%s: %s' % (key, game[key])
-    except Exception as e:
-        print e
-    sys.exit(0)
-    
-    for user in ['wbmccarty']:
-        for id in [0]:
-            for game in getCollectionByUserAndId(user, id, session = session):
-                print 
-                for key in sorted(game.keys(), key=str.lower):
-                    if type(game[key]) is list:
-                        for v in game[key]:
-                            print '%s: %s' % (key, v)
-                    else:    
-                        print '%s: %s' % (key, game[key])
-        sys.exit(0)
-    
-    prettyPrintCollectionByUserAndId('wbmccarty', 54457, session = session)
-    sys.exit(0)
-    
-    prettyPrintCollectionByUserAndId('wbmccarty', 3312, session = session)
-    sys.exit(0)
-    
-    prettyPrintGameById(12333, session = session)
-    sys.exit(0)
-    
-    s = getElementsAndAttributes(session = session)
-    for key in sorted(s.keys(), key=str.lower):
-        print key
-    sys.exit(0)
-  
-    for id in [5, 701]:
-        try:
-            game = getGameById(id, session = session)
-            print 
-            for key in sorted(game.keys(), key=str.lower):
-                if type(game[key]) is list:
-                    for v in game[key]:
-                        print '%s: %s' % (key, v)
-                else:    
-                    print '%s: %s' % (key, game[key])
-        except Exception as e:
-            print e
-    sys.exit(0)
-
-    for user in ['wbmccarty']:
-        for id in [3312]:
-            for game in getCollectionByUserAndId(user, id, session = session):
-                print 
-                for key in sorted(game.keys(), key=str.lower):
-                    if type(game[key]) is list:
-                        for v in game[key]:
-                            print '%s: %s' % (key, v)
-                    else:    
-                        print '%s: %s' % (key, game[key])
-        for id in [0]:
-            for game in getCollectionByUserAndId(user, id, session = session):
-                print 
-                for key in sorted(game.keys(), key=str.lower):
-                    if type(game[key]) is list:
-                        for v in game[key]:
-                            print '%s: %s' % (key, v)
-                    else:    
-                        print '%s: %s' % (key, game[key])
-        sys.exit(0)
-    
-    id = 3312
+
+def openCollection(user, session = None, params = None):
+    '''
+    Open the collection XML of the specified user as a file-like object
+    streaming from the network, waiting for BGG to process the request if it
+    is queued.
+    '''
+    url = collectionUrl(user, params)
+    scheduler = CollectionScheduler(session = session)
+    started = time.time()
+    attempt = 0
+    while True:
+        status, f = httpOpen(url, session = session)
+        if status != 202:
+            return f
+        f.close()
+        if time.time() - started > scheduler.timeout:
+            raise Exception('Collection request for %s was not processed.' % user)
+        time.sleep(scheduler.delay(attempt))
+        attempt += 1
+
+def iterCollection(source, id=0, session = None, params = None):
+    '''
+    Generate a hash for each item of a BGG collection, as parseCollection,
+    while streaming the XML with lxml.etree.iterparse. The source is either a
+    user name, whose collection is fetched, or a file-like object containing
+    collection XML. Each item element is discarded once parsed, so memory use
+    does not grow with the size of the collection.
+    '''
+    if hasattr(source, 'read'):
+        f = source
+    else:
+        f = openCollection(source, session = session, params = params)
     try:
-        game = getGameById(id, session = session)
-        print 
-        for key in sorted(game.keys(), key=str.lower):
-            if type(game[key]) is list:
-                for v in game[key]:
-                    print '%s: %s' % (key, v)
-            else:    
-                print '%s: %s' % (key, game[key])
-    except Exception as e:
-        print e
-    sys.exit(0)
+        context = etree.iterparse(f, events=('end',), tag='item')
+        for event, item in context:
+            if id == 0 or item.get('objectid') == str(id):
+                yield parseCollectionItem(item)
+            item.clear()
+            while item.getprevious() != None:
+                del item.getparent()[0]
+        if context.root == None or context.root.tag != 'items':
+            raise Exception('Collection request failed: %s'
+                            % (context.root != None and elementText(context.root)))
+    finally:
+        if f is not source:
+            f.close()
+
+def iterEnrichCollection(collection, session = None, batch_size = GAMES_BATCH_SIZE,
+                         engine = None):
+    '''
+    Generate merged hashes, as enrichCollection, from an iterable of parsed
+    collection items, such as iterCollection returns. Items are enriched
+    batch_size at a time as they arrive.
+    '''
+    batch = [ ]
+    for item in collection:
+        batch.append(item)
+        if len(batch) == batch_size:
+            for game in enrichCollection(batch, session = session,
+                                         batch_size = batch_size, engine = engine):
+                yield game
+            batch = [ ]
+    if batch:
+        for game in enrichCollection(batch, session = session,
+                                     batch_size = batch_size, engine = engine):
+            yield game
+
+class CollectionStore(object):
+    '''
+    Local copies of users' collections, kept by syncCollection. Each user's
+    state is a JSON file holding the times of the last sync and the last
+    full sync, and the enriched collection items keyed by collection ID.
+    '''
 
-   
+    def __init__(self, directory = SYNC_DIR):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
 
+    def path(self, user):
+        return os.path.join(self.directory, urllib.quote(user, '') + '.json')
 
+    def load(self, user):
+        '''
+        Return the stored state of the specified user, or None.
+        '''
+        try:
+            with open(self.path(user), 'rb') as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def save(self, state):
+        path = self.path(state['user'])
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            json.dump(state, f)
+        os.rename(tmp, path)
+
+    def collection(self, user):
+        '''
+        Return the stored collection of the specified user as a list of
+        hashes, as getCollectionByUserAndId.
+        '''
+        state = self.load(user)
+        if state == None:
+            return [ ]
+        return [state['items'][key] for key in sorted(state['items'], key=int)]
+
+def collectionKey(game):
+    return str(game.get('COLLID', game['BGGID']))
+
+def syncCollection(user, store = None, session = None, full = False,
+                   full_interval = SYNC_FULL_INTERVAL, engine = None):
+    '''
+    Bring the stored copy of the specified user's collection up to date.
+    Normally only the items modified since the last sync are requested and
+    enriched. Every full_interval seconds, or if full is True, the whole
+    collection is requested instead, to detect deletions, which BGG does not
+    report as modifications; even then, only new or modified items are
+    enriched. Return a tuple of the list of changed items and the list of
+    the collection IDs of deleted items.
+    '''
+    if store == None:
+        store = CollectionStore()
+    state = store.load(user)
+    started = time.time()
+    if state == None:
+        state = { 'user':user, 'lastsync':None, 'lastfull':None, 'items':{ } }
+        full = True
+    elif state['lastfull'] == None or started - state['lastfull'] >= full_interval:
+        full = True
+    items = state['items']
+    deleted = [ ]
+    if full:
+        params = None
+    else:
+        since = time.localtime(state['lastsync'] - SYNC_MARGIN)
+        params = { 'modifiedsince':time.strftime('%y-%m-%d %H:%M:%S', since) }
+    collection = parseCollection(getCollectionXml(user, session = session,
+                                                  params = params),
+                                 engine = engine)
+    changed = [ ]
+    for item in collection:
+        old = items.get(collectionKey(item))
+        if old != None and \
+           old.get('STATUS_LASTMODIFIED') == item.get('STATUS_LASTMODIFIED'):
+            # Unchanged, but refresh the collection fields, e.g. stats,
+            # keeping the enriched list fields over the item's empty ones.
+            items[collectionKey(item)] = mergeCollection([item], [old])[0]
+        else:
+            changed.append(item)
+    if full:
+        current = set([collectionKey(item) for item in collection])
+        deleted = [key for key in items if key not in current]
+        for key in deleted:
+            del items[key]
+        state['lastfull'] = started
+    changed = enrichCollection(changed, session = session, engine = engine)
+    for game in changed:
+        items[collectionKey(game)] = game
+    state['lastsync'] = started
+    store.save(state)
+    return changed, deleted
+
+class GameCatalog(object):
+    '''
+    Local SQLite catalog of parsed game records, with indexed queries.
 
-    
+    Tables: games (scalar fields), ranks, links (one row per value of each
+    list field, e.g. boardgamemechanic), and collection (per-user status and
+    private information, by collection ID).
+    '''
 
+    GAMECOLUMNS = [
+        ('age', 'INTEGER'),
+        ('average', 'REAL'),
+        ('averageweight', 'REAL'),
+        ('bayesaverage', 'REAL'),
+        ('description', 'TEXT'),
+        ('image', 'TEXT'),
+        ('maxplayers', 'INTEGER'),
+        ('median', 'REAL'),
+        ('minplayers', 'INTEGER'),
+        ('numcomments', 'INTEGER'),
+        ('numweights', 'INTEGER'),
+        ('owned', 'INTEGER'),
+        ('playingtime', 'INTEGER'),
+        ('stddev', 'REAL'),
+        ('thumbnail', 'TEXT'),
+        ('trading', 'INTEGER'),
+        ('usersrated', 'INTEGER'),
+        ('wanting', 'INTEGER'),
+        ('wishing', 'INTEGER'),
+        ('yearpublished', 'INTEGER'),
+    ]
 
+    COLLECTIONCOLUMNS = STATUSFIELDS + [name for name, type in PRIVATEINFO]
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS games (bggid INTEGER PRIMARY KEY, title TEXT, plaindescription TEXT, %s)'
+            % ', '.join(['%s %s' % c for c in GAMECOLUMNS]),
+        'CREATE TABLE IF NOT EXISTS ranks (bggid INTEGER, name TEXT, value INTEGER, PRIMARY KEY (bggid, name))',
+        'CREATE TABLE IF NOT EXISTS links (bggid INTEGER, kind TEXT, value TEXT)',
+        'CREATE TABLE IF NOT EXISTS collection (user TEXT, collid INTEGER, bggid INTEGER, %s, PRIMARY KEY (user, collid))'
+            % ', '.join(COLLECTIONCOLUMNS),
+        'CREATE INDEX IF NOT EXISTS ranks_name_value ON ranks (name, value)',
+        'CREATE INDEX IF NOT EXISTS links_kind_value ON links (kind, value)',
+        'CREATE INDEX IF NOT EXISTS links_bggid ON links (bggid)',
+        'CREATE INDEX IF NOT EXISTS games_players ON games (minplayers, maxplayers)',
+        'CREATE INDEX IF NOT EXISTS collection_bggid ON collection (bggid)',
+        'CREATE INDEX IF NOT EXISTS collection_wishlist ON collection (user, wishlistpriority)',
+    ]
 
+    def __init__(self, path = CATALOG_FILE):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        self.conn.close()
+
+    def upsert(self, games, user = None, batch_size = CATALOG_BATCH_SIZE):
+        '''
+        Insert or update the specified game hashes or Game records,
+        batch_size per transaction. Fields absent from a record keep their
+        stored values; the stored values of a list field are replaced only if
+        the record has some. Collection status and private information are
+        stored for the given user, if any. Return the number of records.
+        '''
+        n = 0
+        batch = [ ]
+        for game in games:
+            batch.append(game)
+            if len(batch) == batch_size:
+                n += self.upsertBatch(batch, user)
+                batch = [ ]
+        if batch:
+            n += self.upsertBatch(batch, user)
+        return n
+
+    def upsertBatch(self, games, user):
+        columns = ['title', 'plaindescription'] + [c for c, t in self.GAMECOLUMNS]
+        update = 'UPDATE games SET %s WHERE bggid = ?' % \
+            ', '.join(['%s = COALESCE(?, %s)' % (c, c) for c in columns])
+        n = 0
+        with self.conn:
+            for game in games:
+                if not isinstance(game, Game):
+                    game = Game.fromDict(game)
+                if game.bggid == None:
+                    continue
+                n += 1
+                self.conn.execute('INSERT OR IGNORE INTO games (bggid) VALUES (?)',
+                                  (game.bggid,))
+                self.conn.execute(update, [getattr(game, c) for c in columns] +
+                                  [game.bggid])
+                if game.ranks:
+                    self.conn.execute('DELETE FROM ranks WHERE bggid = ?', (game.bggid,))
+                    self.conn.executemany('INSERT INTO ranks VALUES (?, ?, ?)',
+                        [(game.bggid, r.name, r.value) for r in game.ranks])
+                for kind, type in TEXTFIELDS.items():
+                    values = getattr(game, kind)
+                    if type == TYPELIST and values:
+                        self.conn.execute('DELETE FROM links WHERE bggid = ? AND kind = ?',
+                                          (game.bggid, kind))
+                        self.conn.executemany('INSERT INTO links VALUES (?, ?, ?)',
+                            [(game.bggid, kind, v) for v in values])
+                if user != None and (game.status or game.privateinfo):
+                    status = game.status or Status()
+                    privateinfo = game.privateinfo or PrivateInfo()
+                    self.conn.execute('INSERT OR REPLACE INTO collection VALUES (%s)'
+                                      % ', '.join(['?'] * (len(self.COLLECTIONCOLUMNS) + 3)),
+                        [user, game.collid if game.collid != None else game.bggid, game.bggid] +
+                        [getattr(status, c) for c in STATUSFIELDS] +
+                        [getattr(privateinfo, c) for c, t in PRIVATEINFO])
+        return n
+
+    def find(self, mechanic = None, category = None, designer = None,
+             publisher = None, minrank = None, maxrank = None,
+             rank = 'BOARDGAMERANK', players = None, user = None,
+             wishlistpriority = None, limit = None):
+        '''
+        Return a list of hashes of the scalar fields of the catalog games
+        matching all the given criteria, ordered by the named rank. The
+        rank range is inclusive; players must lie between minplayers and
+        maxplayers; wishlistpriority requires user.
+        '''
+        joins = ['LEFT JOIN ranks r ON r.bggid = g.bggid AND r.name = ?']
+        args = [rank]
+        where = [ ]
+        for kind, value in [('boardgamemechanic', mechanic),
+                            ('boardgamecategory', category),
+                            ('boardgamedesigner', designer),
+                            ('boardgamepublisher', publisher)]:
+            if value != None:
+                where.append('g.bggid IN (SELECT bggid FROM links WHERE kind = ? AND value = ?)')
+                args += [kind, value]
+        if minrank != None:
+            where.append('r.value >= ?')
+            args.append(minrank)
+        if maxrank != None:
+            where.append('r.value <= ?')
+            args.append(maxrank)
+        if players != None:
+            where.append('g.minplayers <= ? AND g.maxplayers >= ?')
+            args += [players, players]
+        if user != None:
+            joins.append('JOIN collection c ON c.bggid = g.bggid AND c.user = ?')
+            args.insert(1, user)
+            if wishlistpriority != None:
+                where.append('c.wishlist = 1 AND c.wishlistpriority = ?')
+                args.append(wishlistpriority)
+        sql = 'SELECT DISTINCT g.*, r.value AS rank FROM games g ' + ' '.join(joins)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY r.value IS NULL, r.value, g.bggid'
+        if limit != None:
+            sql += ' LIMIT %d' % int(limit)
+        games = [ ]
+        for row in self.conn.execute(sql, args):
+            game = { }
+            for key in row.keys():
+                if row[key] != None:
+                    game[key] = row[key]
+            game['BGGID'] = game.pop('bggid')
+            if 'title' in game:
+                game['TITLE'] = game.pop('title')
+            if 'plaindescription' in game:
+                game['DESCRIPTION'] = game.pop('plaindescription')
+            games.append(game)
+        return games
+
+    def game(self, bggid, user = None):
+        '''
+        Return the stored record of the specified game as a hash with the
+        keys of getGameById, plus the collection fields of the given user's
+        first copy of it, if any; or None if the game is not in the catalog.
+        '''
+        row = self.conn.execute('SELECT * FROM games WHERE bggid = ?', (bggid,)).fetchone()
+        if row == None:
+            return None
+        record = Game(bggid=bggid, title=row['title'],
+                      plaindescription=row['plaindescription'])
+        for c, t in self.GAMECOLUMNS:
+            setattr(record, c, row[c])
+        for kind, type in TEXTFIELDS.items():
+            if type == TYPELIST:
+                setattr(record, kind, tuple([r[0] for r in self.conn.execute(
+                    'SELECT value FROM links WHERE bggid = ? AND kind = ? ORDER BY rowid',
+                    (bggid, kind))]))
+        record.ranks = tuple([Rank(name=r[0], value=r[1]) for r in self.conn.execute(
+            'SELECT name, value FROM ranks WHERE bggid = ? ORDER BY name', (bggid,))])
+        if user != None:
+            row = self.conn.execute('SELECT * FROM collection WHERE user = ? AND bggid = ? ORDER BY collid',
+                                    (user, bggid)).fetchone()
+            if row != None:
+                record.collid = row['collid']
+                record.status = Status(**dict([(c, row[c]) for c in STATUSFIELDS]))
+                record.privateinfo = PrivateInfo(**dict([(c, row[c]) for c, t in PRIVATEINFO]))
+        return addCommentFields(record.asDict())
+
+class OfferHistory(object):
+    '''
+    Append-only history of marketplace offers and auctions. Each offer is a
+    hash of date (YYYY-MM-DD), place ('BGG' or 'eBay'), offerid, bggid,
+    seller, price, currency, condition, description, title and url.
+
+    Offers are appended as JSON lines to a partition file per date,
+    directory/YYYY/MM/YYYY-MM-DD.jsonl, and never rewritten. A SQLite index,
+    directory/index.db, holds the search fields of each offer and its
+    partition and offset, with indexes on bggid, seller and date. An offer
+    already recorded at the same place, offerid and price is not appended
+    again, so a price change is recorded as a new offer.
+    '''
 
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS offers (place TEXT, offerid TEXT, price REAL, currency TEXT, bggid INTEGER, seller TEXT, date TEXT, partition TEXT, offset INTEGER, PRIMARY KEY (place, offerid, price))',
+        'CREATE INDEX IF NOT EXISTS offers_bggid ON offers (bggid, date)',
+        'CREATE INDEX IF NOT EXISTS offers_seller ON offers (seller, date)',
+        'CREATE INDEX IF NOT EXISTS offers_date ON offers (date)',
+    ]
 
+    def __init__(self, directory = HISTORY_DIR):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.db'),
+                                    check_same_thread = False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        self.conn.close()
+
+    def partition(self, date):
+        return os.path.join(date[:4], date[5:7], date + '.jsonl')
+
+    def append(self, offers):
+        '''
+        Record a list or generator of offers. Return the number of offers
+        not already recorded. An offer without a price is recorded once, as
+        one with a price. The JSON lines are written once the index is
+        committed.
+        '''
+        added = 0
+        lines = collections.OrderedDict()
+        sizes = { }
+        with self.lock:
+            with self.conn:
+                for offer in offers:
+                    key = (offer['place'], unicode(offer['offerid']), offer['price'])
+                    # IS, not =, so that a NULL price matches.
+                    if self.conn.execute('SELECT 1 FROM offers WHERE place = ? AND offerid = ? AND price IS ?',
+                                         key).fetchone():
+                        continue
+                    partition = self.partition(offer['date'])
+                    if partition not in sizes:
+                        path = os.path.join(self.directory, partition)
+                        sizes[partition] = os.path.getsize(path) if os.path.exists(path) else 0
+                    line = json.dumps(offer, sort_keys=True) + '\n'
+                    self.conn.execute('INSERT INTO offers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                      key + (offer.get('currency'), offer.get('bggid'),
+                                             offer.get('seller'), offer['date'], partition,
+                                             sizes[partition]))
+                    sizes[partition] += len(line)
+                    lines.setdefault(partition, [ ]).append(line)
+                    added += 1
+            for partition, partlines in lines.iteritems():
+                path = os.path.join(self.directory, partition)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'ab') as f:
+                    f.write(''.join(partlines))
+        return added
+
+    def reindex(self):
+        '''
+        Rebuild the index from the partition files, e.g. after the index is
+        lost or an append was interrupted.
+        '''
+        with self.lock:
+            with self.conn:
+                self.conn.execute('DELETE FROM offers')
+                for dirpath, dirnames, filenames in os.walk(self.directory):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        if not filename.endswith('.jsonl'):
+                            continue
+                        path = os.path.join(dirpath, filename)
+                        partition = os.path.relpath(path, self.directory)
+                        with open(path, 'rb') as f:
+                            offset = 0
+                            for line in f:
+                                offer = json.loads(line)
+                                key = (offer['place'], unicode(offer['offerid']), offer['price'])
+                                if not self.conn.execute('SELECT 1 FROM offers WHERE place = ? AND offerid = ? AND price IS ?',
+                                                         key).fetchone():
+                                    self.conn.execute('INSERT INTO offers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                        key + (offer.get('currency'), offer.get('bggid'), offer.get('seller'),
+                                               offer['date'], partition, offset))
+                                offset += len(line)
+
+    def query(self, bggid = None, seller = None, place = None, since = None,
+              until = None, limit = None):
+        '''
+        Return the index rows of the offers matching all of the specified
+        criteria, by date. since and until are inclusive YYYY-MM-DD dates.
+        '''
+        where = [ ]
+        args = [ ]
+        for column, op, value in [('bggid', '=', bggid), ('seller', '=', seller),
+                                  ('place', '=', place), ('date', '>=', since),
+                                  ('date', '<=', until)]:
+            if value != None:
+                where.append('%s %s ?' % (column, op))
+                args.append(value)
+        sql = 'SELECT * FROM offers'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY date, place, offerid'
+        if limit != None:
+            sql += ' LIMIT %d' % int(limit)
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def search(self, **criteria):
+        '''
+        Return the offers matching the criteria of query, by date, read from
+        their partitions.
+        '''
+        offers = [ ]
+        for row in self.query(**criteria):
+            with open(os.path.join(self.directory, row['partition']), 'rb') as f:
+                f.seek(row['offset'])
+                offers.append(json.loads(f.readline()))
+        return offers
+
+    def priceHistory(self, bggid, since = None, until = None):
+        '''
+        Return a list of (date, place, price, currency) tuples of the offers of
+        the specified game, by date, from the index alone.
+        '''
+        return [(row['date'], row['place'], row['price'], row['currency'])
+                for row in self.query(bggid = bggid, since = since, until = until)]
+
+offerid_re = re.compile(r'(\d+)/?$')
+
+def offerDate(listdate):
+    '''
+    Return the UTC date, as YYYY-MM-DD, of an RFC 2822 date, e.g. the
+    listdate of a marketplace listing, or of now if it is missing or invalid.
+    '''
+    parsed = email.utils.parsedate_tz(listdate or '')
+    if parsed == None:
+        return datetime.datetime.utcnow().strftime('%Y-%m-%d')
+    timestamp = email.utils.mktime_tz(parsed)
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
 
-from bs4 import BeautifulSoup
+def marketplaceOffers(game):
+    '''
+    Return the marketplace listings of a hash returned by getMarketplaceById
+    as a list of OfferHistory offers.
+    '''
+    listings = { }
+    for key, value in game.iteritems():
+        m = listingkey_re.match(key)
+        if m:
+            listings.setdefault(int(m.group(1)), { })[m.group(2).lower()] = value
+    offers = [ ]
+    for n in sorted(listings):
+        listing = listings[n]
+        url = listing.get('linkhref')
+        m = offerid_re.search(url or '')
+        offers.append({
+            'date':offerDate(listing.get('listdate')),
+            'place':'BGG',
+            'offerid':m.group(1) if m else url,
+            'bggid':game.get('BGGID'),
+            # The XML API listings do not name the seller.
+            'seller':None,
+            'price':listing.get('price'),
+            'currency':listing.get('pricecurrency'),
+            'condition':listing.get('condition'),
+            'description':listing.get('notes'),
+            'title':game.get('TITLE'),
+            'url':url,
+        })
+    return offers
+
+def wishlistOffers(offers):
+    '''
+    Return WishlistOffer records, e.g. from getWishlistByUserId, as a list of
+    OfferHistory offers.
+    '''
+    return [{
+        'date':offerDate(o.pubdate),
+        'place':'BGG',
+        'offerid':str(o.itemid) if o.itemid != None else o.guid,
+        'bggid':o.bggid,
+        'seller':o.seller,
+        'price':o.price,
+        'currency':o.currency,
+        'condition':o.condition,
+        'description':o.title,
+        'title':o.gametitle,
+        'url':o.link,
+    } for o in offers]
+
+def auctionOffers(auctions, date = None):
+    '''
+    Return the auctions of a hash returned by parseGeekbayPage as a list of
+    OfferHistory offers, dated as of the specified date (default: today,
+    UTC).
+    '''
+    date = date or datetime.datetime.utcnow().strftime('%Y-%m-%d')
+    offers = [ ]
+    for bggid in sorted(auctions):
+        for title, auctionurl, auctiontitle, timeleft, currency, price in auctions[bggid]:
+            m = offerid_re.search(auctionurl)
+            offers.append({
+                'date':date,
+                'place':'eBay',
+                'offerid':m.group(1) if m else auctionurl,
+                'bggid':bggid,
+                'seller':None,
+                'price':price,
+                'currency':currency,
+                'condition':None,
+                'description':auctiontitle,
+                'title':title,
+                'url':auctionurl,
+            })
+    return offers
+
+class ConcurrentClient(object):
+    '''
+    Fetch BGG records concurrently, with at most max_inflight requests in
+    flight at once. Results are parsed exactly as by getGameById,
+    getGamesByIds, getMarketplaceById and getCollectionByUserAndId.
 
-import datetime
-import json
-import re
-import urllib
-import urllib2
-import ConfigParser
-import requests
-import sys
-import webbrowser
+    Requests run on worker threads, which overlap the waits on the network;
+    parsing still holds the interpreter lock. Set BGG_URL to direct the
+    requests to a local stub server.
+    '''
+
+    def __init__(self, max_inflight = MAX_INFLIGHT, session = None,
+                 batch_size = GAMES_BATCH_SIZE, engine = None):
+        self.max_inflight = max_inflight
+        self.session = session
+        self.batch_size = batch_size
+        self.engine = engine
+
+    def map(self, fn, args):
+        '''
+        Call fn on each of args from up to max_inflight threads. Return the
+        list of results, in order. If any call raises, re-raise the first
+        such exception after all calls finish.
+        '''
+        args = list(args)
+        results = [None] * len(args)
+        errors = [ ]
+        lock = threading.Lock()
+        pending = iter(range(len(args)))
+        def worker():
+            while True:
+                with lock:
+                    i = next(pending, None)
+                if i == None:
+                    return
+                try:
+                    results[i] = fn(args[i])
+                except Exception:
+                    with lock:
+                        errors.append((i, sys.exc_info()))
+        threads = [threading.Thread(target=worker)
+                   for n in range(min(self.max_inflight, len(args)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            i, (etype, value, tb) = min(errors)
+            raise etype, value, tb
+        return results
+
+    def imap(self, fn, args):
+        '''
+        Call fn on each of args from up to max_inflight threads, as map, but
+        yield the results in order as each becomes available. An exception
+        is re-raised where its result would be yielded.
+        '''
+        args = list(args)
+        results = [None] * len(args)
+        done = [threading.Event() for arg in args]
+        lock = threading.Lock()
+        pending = iter(range(len(args)))
+        def worker():
+            while True:
+                with lock:
+                    i = next(pending, None)
+                if i == None:
+                    return
+                try:
+                    results[i] = (fn(args[i]), None)
+                except Exception:
+                    results[i] = (None, sys.exc_info())
+                done[i].set()
+        for n in range(min(self.max_inflight, len(args))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+        for i in range(len(args)):
+            done[i].wait()
+            result, error = results[i]
+            results[i] = None
+            if error:
+                raise error[0], error[1], error[2]
+            yield result
+
+    def getGame(self, id):
+        return getGameById(id, session = self.session, engine = self.engine)
+
+    def getMarketplace(self, id):
+        return getMarketplaceById(id, session = self.session,
+                                  engine = self.engine)
+
+    def getMarketplaces(self, ids):
+        return self.map(self.getMarketplace, ids)
+
+    def getGames(self, ids):
+        '''
+        Return a list of game records for the specified BGG IDs, as
+        getGamesByIds, fetching the batches concurrently.
+        '''
+        unique = uniqueIds(ids)
+        batches = [unique[i:i + self.batch_size]
+                   for i in range(0, len(unique), self.batch_size)]
+        games = [ ]
+        for batch in self.map(lambda batch: getGamesByIds(batch,
+                                  batch_size = self.batch_size,
+                                  session = self.session,
+                                  engine = self.engine), batches):
+            games.extend(batch)
+        return games
+
+    def getCollection(self, user, id=0):
+        '''
+        Return the collection of the specified user, as
+        getCollectionByUserAndId, fetching the game records concurrently.
+        '''
+        collection = parseCollection(getCollectionXml(user, session = self.session),
+                                     id, self.engine)
+        games = self.getGames([item['BGGID'] for item in collection])
+        return mergeCollection(collection, games)
+
+    def getCollections(self, users, id=0):
+        '''
+        Return the collections of the specified users, as
+        getCollectionsByUsers, fetching the game records concurrently.
+        '''
+        return getCollectionsByUsers(users, id, session = self.session,
+                                     engine = self.engine,
+                                     batch_size = self.batch_size, client = self)
 
 ITEMS_URL = 'http://www.boardgamegeek.com/geekbay/browse?filterwanttobuy=1&sort=endtime'
 COLLECTION_URL = 'http://www.boardgamegeek.com/xmlapi/collection/wbmccarty'
@@ -707,67 +2861,182 @@ SKIP_NOWARN = 2
 SKIP_STATUS = SKIP_OFF
 SKIP_STATUS = SKIP_WARN
 
-def getWTBGame(bggid_text, collection):
+# Polling of the watch daemon, ScanWatcher. Times are in seconds.
+WATCH_MIN_INTERVAL = 60
+WATCH_MAX_INTERVAL = 15 * 60
+WATCH_CRAWL_INTERVAL = 60 * 60
+WATCH_COLLECTION_INTERVAL = 6 * 60 * 60
+
+class WishlistEntry(Record):
     '''
-    Find all instances in the specified collection element of games,
-    represented as item elements, having the specified BGG ID. Return
-    the item element corresponding to the first such game that's WTB, if
-    any. This function is necessary because a single title may be both
-    owned and WTB, especially if the owned version differs from the
-    WTB version.
+    A WTB game of the scanned collection, with the fields reported by
+    scanEbay preformatted, the wishlist comment, parsed, with its syntax
+    error message, if any, and the target price (MAX_PRICE if none).
     '''
-    for item in collection.find_all(objectid=bggid_text):
-        status = item.find('status')
-        wishlist = status.get('wishlist')
-        if wishlist != DONTWANT:
-            return item
-    return None
+    __slots__ = ('bggid', 'year', 'average', 'usersrated', 'bayes', 'numowned',
+                 'priority', 'wishlist', 'parsedcomment', 'commenterror',
+                 'target_price')
 
-def parseComment(s):
+def wishlistEntry(item, parsedcomments = None):
+    '''
+    Return a WishlistEntry for a collection item element. Its wishlist
+    comment is looked up in parsedcomments, a hash returned by
+    parseComments, if given, else parsed. Syntax errors in the comment are
+    not reported here, but by scanEbay for games it finds auctions of.
+    '''
+    try:
+        year = '(%d)' % int(item.find('yearpublished').get_text().strip())
+    except:
+        year = ''
+    try:
+        average = '%.4f' % float(item.find('average').get('value').strip())
+    except:
+        average = 'N/A'
+    try:
+        usersrated =  '%d' % int(item.find('usersrated').get('value').strip())
+    except:
+        usersrated = 'N/A'
+    try:
+        bayes = '%.4f' % float(item.find('bayesaverage').get('value').strip())
+    except:
+        bayes = 'N/A'
+    try:
+        numowned = int(item.find('stats').get('numowned').strip())
+    except:
+        numowned = 0
+    try:
+        wishlist = item.find('wishlistcomment').get_text()
+    except:
+        wishlist = ''
+    commenterror = cachedComment(wishlist)[1]
+    try:
+        if parsedcomments != None and wishlist in parsedcomments:
+            parsedcomment = parsedcomments[wishlist]
+        else:
+            parsedcomment = parseComment(wishlist, verbose = False)
+        if 'wtb' in parsedcomment:
+            target_price = float(parsedcomment['wtb'])
+        else:
+            target_price = MAX_PRICE
+    except:
+        parsedcomment = { }
+        target_price = MAX_PRICE
+    return WishlistEntry(bggid=int(item.get('objectid')), year=year, average=average,
+                         usersrated=usersrated, bayes=bayes, numowned=numowned,
+                         priority=item.find('status').get('wishlistpriority'),
+                         wishlist=wishlist, parsedcomment=parsedcomment,
+                         commenterror=commenterror,
+                         target_price=target_price)
+
+def buildWishlistIndex(collection):
     '''
-    Parse the wishlist comment, returning a hash of name-value pairs.
+    Return a hash, by BGG ID, of a WishlistEntry for each WTB game in the
+    specified collection element, in one pass. The first WTB item of a game
+    wins, as a game may be both owned and WTB, e.g. in different editions.
+    '''
+    items = { }
+    for item in collection.find_all('item'):
+        bggid = int(item.get('objectid'))
+        if bggid not in items and item.find('status').get('wishlist') != DONTWANT:
+            items[bggid] = item
+    comments = [ ]
+    for item in items.itervalues():
+        comment = item.find('wishlistcomment')
+        if comment:
+            comments.append(comment.get_text())
+    parsedcomments = parseComments(comments, verbose = False)
+    return dict((bggid, wishlistEntry(item, parsedcomments))
+                for bggid, item in items.iteritems())
+
+def scanComment(s):
+    '''
+    Parse a wishlist comment in one pass over its comment_token_re tokens.
+    Return a tuple of a hash of the name-value pairs before any syntax error,
+    and the error message, or None.
     '''
-##    print >>sys.stderr, 'Parsing wishlist comment:', s
     parsedComment = { }
-    save_s = s
-    s = s.strip()
+    expect = 'item'
     try:
-        while True:
-            m = config_item_re.match(s)
-            if not m:
-##                print >>sys.stderr, 'Parse complete.'
-                break
-##            print >>sys.stderr, 'Match Object:', m.group(), m.start(), m.end()
-            item = m.group(0).strip().lower()
-##            print >>sys.stderr, 'Found item:', item
-            s = s[m.end():]
-            m = config_assign_re.match(s)
-            if not m: raise Exception('Bad comment syntax: Expected assignment character.')
-##            print >>sys.stderr, 'Match Object:', m.group(), m.start(), m.end()
-            s = s[m.end():]
-            m = config_value_re.match(s)
-            if not m: raise Exception('Bad comment syntax: Expected value.')
-##            print >>sys.stderr, 'Match Object:', m.group(), m.start(), m.end()
-            if m.group(0).startswith('"'):
-                value = m.group(0)[1:-1]
+        for m in comment_token_re.finditer(s):
+            kind = m.lastgroup
+            if expect == 'item':
+                if kind != 'word':
+                    break
+                item = m.group(kind).lower()
+                expect = 'assign'
+            elif expect == 'assign':
+                if kind != 'assign': raise Exception('Bad comment syntax: Expected assignment character.')
+                expect = 'value'
+            elif expect == 'value':
+                if kind not in ['word', 'quoted']: raise Exception('Bad comment syntax: Expected value.')
+                parsedComment[item] = m.group(kind)
+                expect = 'separator'
             else:
-                value = m.group(0).strip()
-            parsedComment[item] = value
-            s = s[m.end():]
-##            print >>sys.stderr, 'len:', len(s)
-            m = config_separator_re.match(s)
-##            print >>sys.stderr, 'Match Object:', m.group(), m.start(), m.end()
-            s = s[m.end():]
+                if kind != 'separator': raise Exception('Bad comment syntax: Expected separator.')
+                expect = 'item'
+        else:
+            if expect == 'assign': raise Exception('Bad comment syntax: Expected assignment character.')
+            if expect == 'value': raise Exception('Bad comment syntax: Expected value.')
     except Exception as e:
-        print >>sys.stderr, e
-        print >>sys.stderr, 'Syntax error in wishlist comment:'
-        print >>sys.stderr, save_s
-        keys = parsedComment.keys()
-        keys.sort()
-        print >>sys.stderr, 'Parsed wishlist comment:'
-        for key in keys:
-            print >>sys.stderr, key, '=', parsedComment[key]
-    return parsedComment        
+        return parsedComment, str(e)
+    return parsedComment, None
+
+def parseComment(s, verbose = True):
+    '''
+    Parse the wishlist comment, returning a hash of name-value pairs, e.g.
+    'WTB=30, cond="like new"' gives { 'wtb':'30', 'cond':'like new' }. On a
+    syntax error, return the pairs before it, and, if verbose, report it.
+    Results are memoized by comment text.
+    '''
+    parsedComment, error = cachedComment(s)
+    if error and verbose:
+        reportCommentError(s, parsedComment, error)
+    return dict(parsedComment)
+
+def cachedComment(s):
+    '''
+    Return the tuple returned by scanComment for the wishlist comment,
+    memoized by comment text. The hash is shared; do not modify it.
+    '''
+    cached = commentCache.get(s)
+    if cached == None:
+        cached = scanComment(s)
+        if len(commentCache) >= COMMENT_CACHE_SIZE:
+            commentCache.clear()
+        commentCache[s] = cached
+    return cached
+
+def reportCommentError(s, parsedComment, error):
+    '''
+    Report a syntax error in a wishlist comment, with the pairs parsed
+    before it.
+    '''
+    print >>sys.stderr, error
+    print >>sys.stderr, 'Syntax error in wishlist comment:'
+    print >>sys.stderr, s
+    keys = parsedComment.keys()
+    keys.sort()
+    print >>sys.stderr, 'Parsed wishlist comment:'
+    for key in keys:
+        print >>sys.stderr, key, '=', parsedComment[key]
+
+def parseComments(comments, verbose = True):
+    '''
+    Parse a list of wishlist comments, each distinct text once. Return a
+    hash of each comment to its parsed hash.
+    '''
+    return dict((s, parseComment(s, verbose)) for s in set(comments))
+
+def addCommentFields(game):
+    '''
+    Add the name-value pairs of the wishlist comment of a game hash, if any,
+    as WISHLISTCOMMENT_<NAME> keys, e.g. WISHLISTCOMMENT_WTB.
+    '''
+    comment = game.get('wishlistcomment', game.get('PRIVATEINFO_WISHLISTCOMMENT'))
+    if comment:
+        for name, value in parseComment(comment, verbose = False).iteritems():
+            game['WISHLISTCOMMENT_' + name.upper()] = value
+    return game
 
 ##hash = parseComment('WTB=30')
 ##keys = hash.keys()
@@ -778,281 +3047,736 @@ def parseComment(s):
 ##sys.exit(0)
 
 
+class SeenSet(object):
+    '''
+    The set of auction IDs already seen by scanEbay, kept in an append-only
+    journal, AUCTION_FILE, of one ID per line, and a SQLite index of the
+    journal, AUCTION_FILE + '.idx', for membership tests.
+
+    The index records the journal offset it covers, and lines appended
+    beyond it, e.g. by a run that crashed before close, are replayed on open,
+    so opening and closing cost is proportional to the IDs added since. A
+    line left incomplete by a crash is dropped. Only new IDs are appended,
+    so the journal holds each ID once and never needs compacting. Supports
+    "in", has_key and item assignment, as the dict it replaces.
+    '''
+
+    def __init__(self, path = AUCTION_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path + '.idx')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+        self.journal = open(path, 'ab+')
+        self.journal.seek(0, 2)
+        size = self.journal.tell()
+        offset = self.meta('offset')
+        if offset > size:
+            # The journal was replaced; reindex it.
+            with self.conn:
+                self.conn.execute('DELETE FROM seen')
+            offset = 0
+        self.replay(offset, size)
+
+    def meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def setMeta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def replay(self, offset, size):
+        '''
+        Index the journal lines from the specified offset, and drop an
+        incomplete last line.
+        '''
+        self.journal.seek(offset)
+        with self.conn:
+            for line in self.journal:
+                if not line.endswith('\n'):
+                    self.journal.truncate(offset)
+                    break
+                self.conn.execute('INSERT OR IGNORE INTO seen VALUES (?)', (line.strip(),))
+                offset += len(line)
+            self.setMeta('offset', offset)
+        self.journal.seek(0, 2)
+
+    def __contains__(self, auctionid):
+        return self.conn.execute('SELECT 1 FROM seen WHERE id = ?',
+                                 (auctionid,)).fetchone() != None
+
+    def has_key(self, auctionid):
+        return auctionid in self
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    def __iter__(self):
+        return iter([row[0] for row in self.conn.execute('SELECT id FROM seen ORDER BY id')])
+
+    def add(self, auctionid):
+        '''
+        Record the specified ID, if new: append it to the journal, then index
+        it. The index is committed by sync or close.
+        '''
+        if auctionid in self:
+            return
+        line = auctionid + '\n'
+        self.journal.write(line)
+        self.journal.flush()
+        self.conn.execute('INSERT INTO seen VALUES (?)', (auctionid,))
+        self.setMeta('offset', self.journal.tell())
+
+    def __setitem__(self, auctionid, value):
+        self.add(auctionid)
+
+    def sync(self):
+        os.fsync(self.journal.fileno())
+        self.conn.commit()
+
+    def close(self):
+        self.sync()
+        self.journal.close()
+        self.conn.close()
+
 def loadSeenFile():
-    try:
-        seen_file = open(AUCTION_FILE, 'r')
-    except IOError:
-        seen_file = open(AUCTION_FILE, 'w+')
-    auctions_seen = { }
-    for line in seen_file.xreadlines():
-        auctionid = line.strip()
-        auctions_seen[auctionid] = True
-    seen_file.close()
-    return auctions_seen
+    '''
+    Return the SeenSet of AUCTION_FILE.
+    '''
+    return SeenSet(AUCTION_FILE)
 
 def saveSeenFile(auctions_seen):
-    seen_file = open(AUCTION_FILE, 'w')
-    auctionids = auctions_seen.keys()
-    auctionids.sort()
-    for auctionid in auctionids:
-        print >>seen_file, auctionid
-    seen_file.close()
+    auctions_seen.close()
 
 game_re = re.compile(r'http://boardgamegeek.com/boardgame/(\d+)/')
 wtb_re  = re.compile(r'WTB[=:](\d+)')
-config_item_re = re.compile(r'\w+\s*')
-config_assign_re = re.compile(r'(=\s*)|(:\s*)')
-config_value_re = re.compile(r'("[^"]*"\s*)|(\w+\s*)')
-config_separator_re = re.compile(r'$|,\s*|;\s*')
+# One token of a wishlist comment: a word, a quoted string, an assignment
+# character, a separator, or any other character.
+comment_token_re = re.compile(r'\s*(?:(?P<word>\w+)|"(?P<quoted>[^"]*)"|(?P<assign>[=:])|(?P<separator>[,;])|(?P<other>\S))')
+
+# Parsed wishlist comments, by text. See parseComment.
+COMMENT_CACHE_SIZE = 4096
+commentCache = { }
 auction_re = re.compile(r'http://boardgamegeek.com/geekstore.php3\?action=viewitem&itemid=(\d*)')
+gameurl_re = re.compile(r'/\w+/(\d+)')
+script_re = re.compile(r'''document.writeln\("<a rel=\'[^']*\' href=\\"([^\\]*)\\">([^<]*)</a>"\);''')
+geekbaypage_re = re.compile(r'([?&/]page(?:id)?[=/])(\d+)')
 
-config = ConfigParser.ConfigParser()
-config.read('bgg_config.ini')
-loginurl = config.get('Login', 'LoginURL')
-bgg_username_name  = u'username'
-bgg_username_value = config.get('Login', 'UserID')
-bgg_password_name  = u'password'
-bgg_password_value = config.get('Login', 'Password')
-
-auctions = { }
-auctions_seen = loadSeenFile()
-
-html = open(HTML_FILE, 'w')
-print >>html, '<HTML>'
-print >>html, '<BODY>'
-print >>html, '<head>'
-print >>html, '<style>'
-print >>html, 'table th, td'
-print >>html, '{'
-print >>html, 'border:1px solid black;'
-print >>html, '}'
-print >>html, 'table'
-print >>html, '{'
-print >>html, 'border-collapse:collapse;'
-print >>html, 'width:800px;'
-print >>html, '}'
-print >>html, '</style>'
-print >>html, '</head>'
-
-collection = BeautifulSoup(urllib2.urlopen(COLLECTION_URL))
-
-config = ConfigParser.ConfigParser()
-config.read('bgg_config.ini')
-loginurl = config.get('Login', 'LoginURL')
-bgg_username_name  = u'username'
-bgg_username_value = config.get('Login', 'UserID')
-bgg_password_name  = u'password'
-bgg_password_value = config.get('Login', 'Password')
-
-payload = { bgg_username_name:bgg_username_value,
-    bgg_password_name:bgg_password_value }
-s = requests.Session()
-r = s.post(loginurl, data=payload)
-##print >>sys.stderr, 'status_code:', r.status_code
-##print >>sys.stderr, r.headers
-##text = r.text.encode('UTF-8') 
-##with open('results1.html', 'w') as f:
-##    f.write(text)
-##webbrowser.open('results1.html')    
-r = s.get(ITEMS_URL)
-##print >>sys.stderr, 'status_code:', r.status_code
-##print >>sys.stderr, r.headers
-##text = r.text.encode('UTF-8') 
-##with open('results2.html', 'w') as f:
-##    f.write(text)
-##webbrowser.open('results2.html')    
-
-soup = BeautifulSoup(r.text.encode('UTF-8'))
-##print >>sys.stderr, soup.prettify()
-table = soup.find('table', class_='forum_table sf')
-##print >>sys.stderr, table.prettify()
-for tr in table.find_all('tr')[1:]:
-##    print >>sys.stderr, tr.prettify()
-    gamelink = tr.find('a')
-    gameurl = gamelink.get('href')
-    gameurl_re = re.compile(r'/\w+/(\d+)')
-    m = gameurl_re.match(gameurl)
-    if not m:
-        print >>sys.stderr, 'no match for url:', gameurl
-    else:
+class Auction(Record):
+    '''
+    A geekbay auction of a game on the wishlist.
+    '''
+    __slots__ = ('bggid', 'title', 'url', 'auctiontitle', 'timeleft', 'currency', 'price')
+
+def parseAuctions(page):
+    '''
+    Parse a geekbay browse page, or its lxml.html document, with XPath
+    restricted to the forum_table. Return a list of Auction records, in page
+    order.
+    '''
+    if not etree.iselement(page):
+        page = lxml.html.fromstring(page)
+    auctions = [ ]
+    for tr in page.xpath('(//table[@class="forum_table sf"])[1]//tr[td]'):
+        gamelink = tr.find('.//a')
+        gameurl = gamelink.get('href')
+        m = gameurl_re.match(gameurl)
+        if not m:
+            print >>sys.stderr, 'no match for url:', gameurl
+            continue
         bggid = int(m.group(1))
-    title = gamelink.get_text().strip()
-    script = tr.find('script').get_text().strip()
-    script_re = re.compile(r'''document.writeln\("<a rel=\'[^']*\' href=\\"([^"]*)">([^<]*)</a>"\);''')
-    script_re = re.compile(r'''document.writeln\("<a rel=\'[^']*\' href=\\"([^\\]*)\\">([^<]*)</a>"\);''')
-    m = script_re.match(script)
-    if not m:
-        print >>sys.stderr, 'no match for script'
-    else:
+        title = unicode(gamelink.text_content().strip())
+        script = ''.join(tr.xpath('.//script/text()')).strip()
+        m = script_re.match(script)
+        if not m:
+            print >>sys.stderr, 'no match for script'
+            continue
         auctionurl = 'http://www.boardgamegeek.com' + m.group(1)
-        auctiontitle = m.group(2)
-    td = tr.find_all('td')
-    timeleft = td[2].get_text().strip()
-    price = tr.find('span', class_='price').get_text().strip()
-##    print >>sys.stderr, 'price:', price
-    ndx = price.rfind(' ')
-    currency = price[:ndx]
-    price = float(price[ndx + 1:])
-
-##    print >>sys.stderr, 'gameurl:', gameurl
-##    print >>sys.stderr, 'title:', title
-##    print >>sys.stderr, 'auctionurl:', auctionurl
-##    print >>sys.stderr, 'auctiontitle:', auctiontitle
-##    print >>sys.stderr, 'timeleft:', timeleft
-##    print >>sys.stderr, 'currency:', currency
-##    print >>sys.stderr, 'price:', price
-##    print >>sys.stderr
-
-    if bggid in auctions:
-        auctions[bggid].append( (title, auctionurl, auctiontitle, timeleft, currency, price) )
-    else:
-        auctions[bggid] = [ (title, auctionurl, auctiontitle, timeleft, currency, price) ]
-
-keys = auctions.keys()
-keys.sort()
-for bggid in keys:
-    bggid_text = '%d' % bggid
-    item = getWTBGame(bggid_text, collection)
-    if not item:
-        print >>sys.stderr, 'ERROR: Unable to find WTB game record for BGG ID', bggid_text
-        continue
-##    print >>sys.stderr, item.prettify()
-##    sys.exit(0)
-    try:
-        year = '(%d)' % int(item.find('yearpublished').get_text().strip())
-    except:
-        year = ''
-    try:
-        average = '%.4f' % float(item.find('average').get('value').strip())
-    except:
-        average = 'N/A'
-    try:
-        usersrated =  '%d' % int(item.find('usersrated').get('value').strip())
-    except:
-        usersrated = 'N/A'
-    try:
-        bayes = '%.4f' % float(item.find('bayesaverage').get('value').strip())
-    except:
-        bayes = 'N/A'
-    try:
-        numowned = int(item.find('stats').get('numowned').strip())
-    except:
-        numowned = 0
-    status = item.find('status')
-    priority = status.get('wishlistpriority')
-    if priority == DONTBUY: continue
-    for title, auctionurl, auctiontitle, timeleft, currency, price in auctions[bggid]:
-        
-##        print >>sys.stderr, 'title:', title
-##        print >>sys.stderr, 'bggid:', bggid
+        auctiontitle = unicode(m.group(2))
+        td = tr.findall('td')
+        timeleft = unicode(td[2].text_content().strip())
+        price = tr.xpath('.//span[@class="price"]')[0].text_content().strip()
+        ndx = price.rfind(' ')
+        currency = unicode(price[:ndx])
+        price = float(price[ndx + 1:])
+        auctions.append(Auction(bggid=bggid, title=title, url=auctionurl,
+                                auctiontitle=auctiontitle, timeleft=timeleft,
+                                currency=currency, price=price))
+    return auctions
+
+def groupAuctions(auctions):
+    '''
+    Return a hash, by BGG ID, of lists of (title, auctionurl, auctiontitle,
+    timeleft, currency, price) tuples of the specified Auction records.
+    '''
+    grouped = { }
+    for a in auctions:
+        grouped.setdefault(a.bggid, [ ]).append(
+            (a.title, a.url, a.auctiontitle, a.timeleft, a.currency, a.price))
+    return grouped
 
-        if priority == DONTBUY:
-            print 'Skipping id=%d title "%s", due to DON\'T BUY' \
-                  % (bggid, title, currency)
-            print
+def parseGeekbayPage(page):
+    '''
+    Parse a geekbay browse page. Return a hash, by BGG ID, of lists of
+    (title, auctionurl, auctiontitle, timeleft, currency, price) tuples.
+    '''
+    return groupAuctions(parseAuctions(page))
+
+def geekbayPageKey(url):
+    '''
+    Return the host, path and sorted query parameters of a geekbay browse
+    URL, less its page number, for comparing the result pages of a browse.
+    '''
+    parts = urlparse.urlsplit(url)
+    query = [(k, v) for k, v in urlparse.parse_qsl(parts.query, keep_blank_values=True)
+             if k not in ('page', 'pageid')]
+    return parts.netloc, re.sub(r'/page/\d+', '', parts.path), sorted(query)
+
+def geekbayPageUrls(doc, url):
+    '''
+    Return the URLs of the second through last result pages linked from the
+    lxml.html document of the first page, at the specified URL. Only links to
+    other pages of the same browse count; any other link with a page number
+    (e.g., to a forum thread) is ignored.
+    '''
+    key = geekbayPageKey(url)
+    last = 1
+    prefix = suffix = None
+    for href in doc.xpath('//a/@href'):
+        href = urlparse.urljoin(url, href)
+        m = geekbaypage_re.search(href)
+        if m and int(m.group(2)) > last and geekbayPageKey(href) == key:
+            last = int(m.group(2))
+            prefix, suffix = href[:m.start(2)], href[m.end(2):]
+    return [prefix + str(n) + suffix for n in range(2, last + 1)]
+
+def crawlGeekbay(url = ITEMS_URL, session = None, max_inflight = MAX_INFLIGHT):
+    '''
+    Generate the Auction records of every result page of a geekbay browse
+    URL, in page order. The pages after the first are discovered from its
+    pagination links and fetched concurrently, up to max_inflight at once.
+    '''
+    doc = lxml.html.fromstring(httpGet(url, session = session))
+    for auction in parseAuctions(doc):
+        yield auction
+    client = ConcurrentClient(max_inflight, session)
+    for auctions in client.imap(lambda u: parseAuctions(httpGet(u, session = session)),
+                                geekbayPageUrls(doc, url)):
+        for auction in auctions:
+            yield auction
+
+def scanEbay(configfile = 'bgg_config.ini', history = None):
+    '''
+    Scan the geekbay auctions of games on the wishlist of the logged-in user,
+    report those at or below the target price in the wishlist comment to
+    HTML_FILE, and open it in a browser. If an OfferHistory is given, record
+    all the auctions scanned in it.
+    '''
+    auctions_seen = loadSeenFile()
+
+    html = open(HTML_FILE, 'w')
+    print >>html, '<HTML>'
+    print >>html, '<BODY>'
+    print >>html, '<head>'
+    print >>html, '<style>'
+    print >>html, 'table th, td'
+    print >>html, '{'
+    print >>html, 'border:1px solid black;'
+    print >>html, '}'
+    print >>html, 'table'
+    print >>html, '{'
+    print >>html, 'border-collapse:collapse;'
+    print >>html, 'width:800px;'
+    print >>html, '}'
+    print >>html, '</style>'
+    print >>html, '</head>'
+
+    collection = BeautifulSoup(httpGet(COLLECTION_URL))
+
+    s = login(configfile = configfile)
+##    print >>sys.stderr, 'status_code:', r.status_code
+##    print >>sys.stderr, r.headers
+##    text = r.text.encode('UTF-8') 
+##    with open('results1.html', 'w') as f:
+##        f.write(text)
+##    webbrowser.open('results1.html')    
+    auctions = groupAuctions(crawlGeekbay(ITEMS_URL, session = s))
+##    print >>sys.stderr, 'status_code:', r.status_code
+##    print >>sys.stderr, r.headers
+##    text = r.text.encode('UTF-8') 
+##    with open('results2.html', 'w') as f:
+##        f.write(text)
+##    webbrowser.open('results2.html')    
+
+    if history != None:
+        history.append(auctionOffers(auctions))
+
+    wishlistIndex = buildWishlistIndex(collection)
+    keys = auctions.keys()
+    keys.sort()
+    for bggid in keys:
+        entry = wishlistIndex.get(bggid)
+        if not entry:
+            print >>sys.stderr, 'ERROR: Unable to find WTB game record for BGG ID', bggid
             continue
-        try:
-            wishlist = item.find('wishlistcomment').get_text()
-##            print >>sys.stderr, 'got wishlist'
-        except:
-            wishlist = ''
-##            print >>sys.stderr, 'failed wishlist'
-##            if bggid == 701:
-##                print >>sys.stderr, item.prettify()
-##        print >>sys.stderr, 'wishlist:', wishlist
-        try:
-            parseHash = parseComment(wishlist)
-            if 'wtb' in parseHash:
-##                print 'wtb:', parseHash['wtb']
-                target_price = float(parseHash['wtb'])
-##                print >>sys.stderr, 'got target_price'
-            else:
-                target_price = MAX_PRICE
-        except:
-            parseHash = { }
-            target_price = MAX_PRICE
-##            print >>sys.stderr, 'failed target_price'
-##        print >>sys.stderr, 'wishlist:', wishlist
-##        print >>sys.stderr, 'target_price:', target_price
-        # auctionurl needs to be an id
-        if (SKIP_STATUS == SKIP_WARN or SKIP_STATUS == SKIP_NOWARN) \
-           and auctions_seen.has_key(auctionurl):
-                if SKIP_STATUS == SKIP_WARN:
-                    print '\nSkipping title "%s", due to old news' \
-                      % title
-                continue
-        auctions_seen[auctionurl] = True
-        if currency != '$':
-                print 'Skipping id=%d title "%s", due to non-US currency: %s' \
+        year = entry.year
+        average = entry.average
+        usersrated = entry.usersrated
+        bayes = entry.bayes
+        numowned = entry.numowned
+        priority = entry.priority
+        if priority == DONTBUY: continue
+        wishlist = entry.wishlist
+        if entry.commenterror:
+            reportCommentError(wishlist, entry.parsedcomment, entry.commenterror)
+        target_price = entry.target_price
+        for title, auctionurl, auctiontitle, timeleft, currency, price in auctions[bggid]:
+
+##            print >>sys.stderr, 'title:', title
+##            print >>sys.stderr, 'bggid:', bggid
+
+            if priority == DONTBUY:
+                print 'Skipping id=%d title "%s", due to DON\'T BUY' \
                       % (bggid, title, currency)
                 print
                 continue
-        if price > target_price:
-                print 'Skipping id=%d title "%s", price $%.2f exceeds target $%.2f' \
-                      % (bggid, title, price, target_price)
-                print
-                continue
-##        print 'bggid:', bggid
-##        print 'title:', title
-##        print 'auctionurl:', auctionurl
-##        print 'auctiontitle:', auctiontitle
-##        print 'timeleft:', timeleft
-##        print 'currency:', currency
-##        print 'price:', '%.2f' % price
-##        if target_price == MAX_PRICE:
-##            print 'target price: None set'
-##        else:
-##            print 'target price:', '%.2f' % target_price
-##        print
-        gameurl = GAME_URL % bggid
-        print >>html, '<div style="font-size:125%%;">&nbsp;<A target="_blank" HREF="%s"><B>%s %s</B></A></div>' % (gameurl, title, year)
-        print >>html, '<TABLE>'
-        print >>html, '<colgroup>'
-        print >>html, '    <col width="40%">'
-        print >>html, '    <col width="40%">'
-        print >>html, '    <col width="20%">'
-        print >>html, '</colgroup>'
-        print >>html, '<TR>'
-        print >>html, '<TD colspan="3"><div style="background-color:#E8E8E8;"><B>&nbsp;Auction Title: </B><A target="_blank" HREF="%s">%s</A></div></TD>' % (auctionurl, auctiontitle)
-        print >>html, '</TR>'
-        if target_price == MAX_PRICE:
-            target = ''
-        else:
-            target = '(<b>Target: </b>$ %.2f)' % target_price
-        print >>html, '<TR>'
-        print >>html, '<TD><div style="background-color:#E8E8E8;" ><P><B>&nbsp;Price: </B> %s %.2f&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;%s</P></div></TD>' % (currency, price, target)
-        if priority == '1':
-            priorityname = 'Must Have'
-        elif priority == '2':
-            priorityname = 'Love to Have'
-        elif priority == '3':
-            priorityname = 'Like to Have'
-        elif priority == '4':
-            priorityname = 'Thinking About It'
-        elif priority == '5':
-            priorityname = 'DO NOT BUY'
-        else:
-            priorityname = 'UNKNOWN PRIORITY'
-        print >>html, '<TD><div style="background-color:#E8E8E8;" ><P><B>&nbsp;Priority: </B> %s</P></div></TD>' % priorityname
-        print >>html, '<TD><div style="background-color:#E8E8E8;" ><P><B>&nbsp;Time Left: </B> %s</P></div></TD>' % timeleft
-        print >>html, '</TR>'
-        print >>html, '<TR>'
-        print >>html, '<TD colspan="3"><div style="background-color:#E8E8E8;"><b>&nbsp;Average: </b>%s&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<b>Users Rated: </b>%s&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<b>Bayes: </b>%s&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<b>Number Owned: </b>%d</div></TD>' % (average, usersrated, bayes, numowned)
-        print >>html, '</TR>'
-        if wishlist != '':
+            # auctionurl needs to be an id
+            if (SKIP_STATUS == SKIP_WARN or SKIP_STATUS == SKIP_NOWARN) \
+               and auctions_seen.has_key(auctionurl):
+                    if SKIP_STATUS == SKIP_WARN:
+                        print '\nSkipping title "%s", due to old news' \
+                          % title
+                    continue
+            auctions_seen[auctionurl] = True
+            if currency != '$':
+                    print 'Skipping id=%d title "%s", due to non-US currency: %s' \
+                          % (bggid, title, currency)
+                    print
+                    continue
+            if price > target_price:
+                    print 'Skipping id=%d title "%s", price $%.2f exceeds target $%.2f' \
+                          % (bggid, title, price, target_price)
+                    print
+                    continue
+##            print 'bggid:', bggid
+##            print 'title:', title
+##            print 'auctionurl:', auctionurl
+##            print 'auctiontitle:', auctiontitle
+##            print 'timeleft:', timeleft
+##            print 'currency:', currency
+##            print 'price:', '%.2f' % price
+##            if target_price == MAX_PRICE:
+##                print 'target price: None set'
+##            else:
+##                print 'target price:', '%.2f' % target_price
+##            print
+            gameurl = GAME_URL % bggid
+            print >>html, '<div style="font-size:125%%;">&nbsp;<A target="_blank" HREF="%s"><B>%s %s</B></A></div>' % (gameurl, title, year)
+            print >>html, '<TABLE>'
+            print >>html, '<colgroup>'
+            print >>html, '    <col width="40%">'
+            print >>html, '    <col width="40%">'
+            print >>html, '    <col width="20%">'
+            print >>html, '</colgroup>'
             print >>html, '<TR>'
-            print >>html, '<TD colspan="3"><div style="background-color:#E8E8E8;"><B>&nbsp;Wishlist: </B>%s</div></TD>' % (wishlist)
+            print >>html, '<TD colspan="3"><div style="background-color:#E8E8E8;"><B>&nbsp;Auction Title: </B><A target="_blank" HREF="%s">%s</A></div></TD>' % (auctionurl, auctiontitle)
             print >>html, '</TR>'
-        print >>html, '</TABLE>'
-        print >>html, '<br/>'
-        print >>html, '<br/>'
-
-saveSeenFile(auctions_seen)
-##print
-##print
-##print 'Game bargains found: %d' % n
-print >>html, '</BODY>'
-print >>html, '</HTML>'
-html.close()
-webbrowser.open(HTML_FILE)
-sys.exit(0)
+            if target_price == MAX_PRICE:
+                target = ''
+            else:
+                target = '(<b>Target: </b>$ %.2f)' % target_price
+            print >>html, '<TR>'
+            print >>html, '<TD><div style="background-color:#E8E8E8;" ><P><B>&nbsp;Price: </B> %s %.2f&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;%s</P></div></TD>' % (currency, price, target)
+            if priority == '1':
+                priorityname = 'Must Have'
+            elif priority == '2':
+                priorityname = 'Love to Have'
+            elif priority == '3':
+                priorityname = 'Like to Have'
+            elif priority == '4':
+                priorityname = 'Thinking About It'
+            elif priority == '5':
+                priorityname = 'DO NOT BUY'
+            else:
+                priorityname = 'UNKNOWN PRIORITY'
+            print >>html, '<TD><div style="background-color:#E8E8E8;" ><P><B>&nbsp;Priority: </B> %s</P></div></TD>' % priorityname
+            print >>html, '<TD><div style="background-color:#E8E8E8;" ><P><B>&nbsp;Time Left: </B> %s</P></div></TD>' % timeleft
+            print >>html, '</TR>'
+            print >>html, '<TR>'
+            print >>html, '<TD colspan="3"><div style="background-color:#E8E8E8;"><b>&nbsp;Average: </b>%s&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<b>Users Rated: </b>%s&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<b>Bayes: </b>%s&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<b>Number Owned: </b>%d</div></TD>' % (average, usersrated, bayes, numowned)
+            print >>html, '</TR>'
+            if wishlist != '':
+                print >>html, '<TR>'
+                print >>html, '<TD colspan="3"><div style="background-color:#E8E8E8;"><B>&nbsp;Wishlist: </B>%s</div></TD>' % (wishlist)
+                print >>html, '</TR>'
+            print >>html, '</TABLE>'
+            print >>html, '<br/>'
+            print >>html, '<br/>'
+
+    saveSeenFile(auctions_seen)
+##    print
+##    print
+##    print 'Game bargains found: %d' % n
+    print >>html, '</BODY>'
+    print >>html, '</HTML>'
+    html.close()
+    webbrowser.open(HTML_FILE)
+
+
+
+timeleft_re = re.compile(r'(\d+)\s*([dhms])')
+TIMELEFT_UNITS = { 'd':24 * 60 * 60, 'h':60 * 60, 'm':60, 's':1 }
+
+def parseTimeLeft(timeleft):
+    '''
+    Return the seconds left of a geekbay auction time left, e.g. '1d 4h',
+    or None if it has none.
+    '''
+    parts = timeleft_re.findall(timeleft or '')
+    if not parts:
+        return None
+    return sum(int(n) * TIMELEFT_UNITS[unit] for n, unit in parts)
+
+class WatchMatch(Record):
+    '''
+    An auction ('eBay') or marketplace listing ('BGG') of a wishlist game at
+    or below its target price, found by ScanWatcher.
+    '''
+    __slots__ = ('place', 'bggid', 'title', 'url', 'description', 'currency',
+                 'price', 'target_price', 'priority', 'timeleft')
+
+def printMatch(match):
+    line = u'%s\t%d\t%s\t%s %.2f\t%s\t%s\t%s' % (match.place, match.bggid, match.title,
+        match.currency, match.price, match.timeleft or '', match.description or '', match.url)
+    print line.encode('utf-8')
+    sys.stdout.flush()
+
+class ScanWatcher(object):
+    '''
+    Long-running form of scanEbay. The session, wishlist index and SeenSet
+    are kept between polls, and each poll, or tick, is one small request.
+    Ticks alternate between the first geekbay result page, or, every
+    crawl_interval seconds, all of them, and the marketplace: given the BGG
+    user ID, the new offers of the wishlist RSS feed (see
+    getWishlistByUserId), else the listings of the next wishlist game in
+    turn. New auctions and listings at or below the
+    target price are handed to on_match, once each; every auction and
+    listing seen is recorded in history, if given.
+
+    The delay between ticks adapts to the auctions being watched: a quarter
+    of the shortest time left of a matching auction, between min_interval
+    and max_interval. The collection is refetched every
+    collection_interval seconds; while BGG has the request queued, it is
+    re-polled with the backoff of CollectionScheduler instead.
+    '''
+
+    def __init__(self, configfile = 'bgg_config.ini', session = None, userid = None,
+                 items_url = ITEMS_URL, collection_url = COLLECTION_URL,
+                 seen = None, history = None, on_match = printMatch,
+                 min_interval = WATCH_MIN_INTERVAL, max_interval = WATCH_MAX_INTERVAL,
+                 crawl_interval = WATCH_CRAWL_INTERVAL,
+                 collection_interval = WATCH_COLLECTION_INTERVAL):
+        self.session = session or login(configfile = configfile)
+        self.userid = userid
+        self.wishlist_state = { }
+        self.items_url = items_url
+        self.collection_url = collection_url
+        self.seen = seen if seen != None else loadSeenFile()
+        self.history = history
+        self.on_match = on_match
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.crawl_interval = crawl_interval
+        self.collection_interval = collection_interval
+        self.index = { }
+        self.watching = { }
+        self.ticks = 0
+        self.next_crawl = 0
+        self.next_collection = 0
+        self.collection_attempts = 0
+        self.scheduler = CollectionScheduler(session = self.session)
+        self.marketplace_ids = collections.deque()
+
+    def refreshCollection(self):
+        '''
+        Rebuild the wishlist index, unless the collection request is queued.
+        '''
+        xml = httpGet(self.collection_url, session = self.session)
+        if isQueued(xml):
+            return False
+        self.index = buildWishlistIndex(BeautifulSoup(xml, 'xml'))
+        self.marketplace_ids = collections.deque(sorted(bggid for bggid, entry in self.index.items()
+                                                        if entry.priority != DONTBUY))
+        return True
+
+    def match(self, place, bggid, title, url, description, currency, price, timeleft = None):
+        '''
+        Return a WatchMatch if the offer is of a wishlist game, new, in US
+        dollars and at or below the target price, else None. Offers are
+        marked seen whether or not they match, as by scanEbay.
+        '''
+        entry = self.index.get(bggid)
+        if entry == None or entry.priority == DONTBUY or url in self.seen:
+            return None
+        self.seen[url] = True
+        if currency not in ['$', 'USD'] or price == None or price > entry.target_price:
+            return None
+        return WatchMatch(place=place, bggid=bggid, title=title, url=url,
+                          description=description, currency=currency, price=price,
+                          target_price=entry.target_price, priority=entry.priority,
+                          timeleft=timeleft)
+
+    def pollAuctions(self, now):
+        if now >= self.next_crawl:
+            auctions = list(crawlGeekbay(self.items_url, session = self.session))
+            self.next_crawl = now + self.crawl_interval
+        else:
+            auctions = parseAuctions(httpGet(self.items_url, session = self.session))
+        if self.history != None:
+            self.history.append(auctionOffers(groupAuctions(auctions)))
+        matches = [ ]
+        for a in auctions:
+            entry = self.index.get(a.bggid)
+            if entry != None and entry.priority != DONTBUY and a.price <= entry.target_price:
+                left = parseTimeLeft(a.timeleft)
+                if left != None:
+                    self.watching[a.url] = now + left
+            m = self.match('eBay', a.bggid, a.title, a.url, a.auctiontitle,
+                           a.currency, a.price, a.timeleft)
+            if m:
+                matches.append(m)
+        return matches
+
+    def pollWishlist(self, now):
+        offers = list(getWishlistByUserId(self.userid, session = self.session,
+                                          state = self.wishlist_state))
+        if self.history != None:
+            self.history.append(wishlistOffers(offers))
+        matches = [ ]
+        for o in offers:
+            m = self.match('BGG', o.bggid, o.gametitle, o.link, o.condition,
+                           o.currency, o.price)
+            if m:
+                matches.append(m)
+        return matches
+
+    def pollMarketplace(self, now):
+        if self.userid != None:
+            return self.pollWishlist(now)
+        if not self.marketplace_ids:
+            return [ ]
+        bggid = self.marketplace_ids[0]
+        self.marketplace_ids.rotate(-1)
+        game = getMarketplaceById(bggid, session = self.session, engine = 'lxml')
+        offers = marketplaceOffers(game)
+        if self.history != None:
+            self.history.append(offers)
+        matches = [ ]
+        for offer in offers:
+            m = self.match('BGG', bggid, offer['title'], offer['url'], offer['condition'],
+                           offer['currency'], offer['price'])
+            if m:
+                matches.append(m)
+        return matches
+
+    def delay(self, now):
+        '''
+        Return the seconds to wait before the next tick.
+        '''
+        for url, ends in self.watching.items():
+            if ends <= now:
+                del self.watching[url]
+        if not self.watching:
+            delay = self.max_interval
+        else:
+            delay = max(self.min_interval,
+                        min(self.max_interval, (min(self.watching.values()) - now) / 4.0))
+        if self.collection_attempts:
+            # The collection request is queued; re-poll when due.
+            delay = min(delay, max(0.0, self.next_collection - now))
+        return delay
+
+    def tick(self, now = None):
+        '''
+        Poll once. Return the list of new matches, after handing each to
+        on_match.
+        '''
+        now = now or time.time()
+        if now >= self.next_collection:
+            if self.refreshCollection():
+                self.next_collection = now + self.collection_interval
+                self.collection_attempts = 0
+            else:
+                self.next_collection = now + self.scheduler.delay(self.collection_attempts)
+                self.collection_attempts += 1
+        if not self.index:
+            return [ ]
+        if self.ticks % 2 == 0 or (self.userid == None and not self.marketplace_ids):
+            matches = self.pollAuctions(now)
+        else:
+            matches = self.pollMarketplace(now)
+        self.ticks += 1
+        self.seen.sync()
+        for m in matches:
+            self.on_match(m)
+        return matches
+
+    def run(self, ticks = None):
+        '''
+        Tick until interrupted, or for the specified number of ticks. A tick
+        that fails is reported, and retried after max_interval.
+        '''
+        try:
+            n = 0
+            while ticks == None or n < ticks:
+                n += 1
+                try:
+                    self.tick()
+                    delay = self.delay(time.time())
+                except Exception as e:
+                    print >>sys.stderr, 'Watch tick failed:', e
+                    delay = self.max_interval
+                if ticks == None or n < ticks:
+                    time.sleep(delay)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        saveSeenFile(self.seen)
+
+def printGame(game, out = sys.stdout):
+    '''
+    Print the fields of a game hash, one per line, sorted by key, with a
+    line per value of a list field.
+    '''
+    for key in sorted(game.keys(), key=str.lower):
+        values = game[key] if type(game[key]) is list else [game[key]]
+        for v in values:
+            line = u'%s: %s' % (key, v)
+            print >>out, line.encode('utf-8')
+
+def readFile(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def printGames(games, format, out = sys.stdout):
+    if format == 'text':
+        for game in games:
+            print >>out
+            printGame(game, out)
+    else:
+        exportGames(games, out, format)
+
+def main(argv = None):
+    '''
+    The command-line interface. Run with --help for the subcommands and
+    options. Each subcommand with --file works offline, on a saved response.
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(prog='pyBGG',
+        description='Query the BoardGameGeek.com web site.')
+    parser.add_argument('--config', default='bgg_config.ini',
+                        help='config file with the login credentials')
+    parser.add_argument('--login', action='store_true',
+                        help='log in before fetching, e.g. for private collection fields')
+    parser.add_argument('--engine', choices=['bs4', 'lxml'], help='XML parser engine')
+    parser.add_argument('--cache', action='store_true',
+                        help='cache responses in ' + CACHE_DIR)
+    parser.add_argument('--metrics', metavar='FILE', help='write metrics to FILE at exit')
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('game', help='print game records')
+    command.add_argument('ids', nargs='*', type=int, metavar='id')
+    command.add_argument('--file', help='saved boardgame XML to parse instead')
+    command.add_argument('--format', choices=['text', 'jsonl', 'csv'], default='text')
+
+    command = commands.add_parser('collection', help='print the collection of a user')
+    command.add_argument('user', nargs='?')
+    command.add_argument('--id', type=int, default=0, help='only the game with this BGG ID')
+    command.add_argument('--file', help='saved collection XML to parse instead, unenriched')
+    command.add_argument('--format', choices=['text', 'jsonl', 'csv'], default='text')
+
+    command = commands.add_parser('marketplace', help='print the marketplace listings of games')
+    command.add_argument('ids', nargs='*', type=int, metavar='id')
+    command.add_argument('--file', help='saved boardgame marketplace XML to parse instead')
+    command.add_argument('--format', choices=['text', 'jsonl', 'csv'], default='text')
+
+    command = commands.add_parser('wishlist',
+        help='print the marketplace offers of games on the wishlist of a user')
+    command.add_argument('userid', nargs='?', type=int)
+    command.add_argument('--file', help='saved wishlist RSS to parse instead')
+
+    command = commands.add_parser('scan', help='scan geekbay for wishlist auctions')
+    command.add_argument('--file', help='saved geekbay page to parse and print instead')
+
+    command = commands.add_parser('watch',
+        help='poll geekbay and the marketplace, printing new wishlist matches')
+    command.add_argument('--min-interval', type=float, default=WATCH_MIN_INTERVAL,
+                         help='shortest delay between polls, in seconds')
+    command.add_argument('--max-interval', type=float, default=WATCH_MAX_INTERVAL,
+                         help='longest delay between polls, in seconds')
+    command.add_argument('--history', action='store_true',
+                         help='record the offers seen in ' + HISTORY_DIR)
+    command.add_argument('--userid', type=int,
+                         help='BGG user ID, to poll the wishlist RSS for marketplace offers')
+
+    args = parser.parse_args(argv)
+    if args.cache:
+        setHttpCache(HttpCache())
+    if args.metrics:
+        enableMetrics(args.metrics, 'prometheus' if args.metrics.endswith('.prom') else 'json')
+    session = None
+    if args.login and not getattr(args, 'file', None):
+        session = login(configfile = args.config)
+
+    if args.command in ['game', 'marketplace']:
+        if args.file:
+            tree = parseXml(readFile(args.file), args.engine)
+            games = [parseBoardgame(b) for b in findElements(tree, 'boardgame')
+                     if b.get('objectid') != None and not findElements(b, 'error')]
+        elif args.command == 'game':
+            games = getGamesByIds(args.ids, session = session, engine = args.engine)
+        else:
+            games = [getMarketplaceById(id, session = session, engine = args.engine)
+                     for id in args.ids]
+        printGames(games, args.format)
+    elif args.command == 'collection':
+        if args.file:
+            games = parseCollection(readFile(args.file), args.id, args.engine)
+        elif args.user:
+            games = getCollectionByUserAndId(args.user, args.id, session = session,
+                                             engine = args.engine)
+        else:
+            parser.error('collection: a user or --file is required')
+        printGames(games, args.format)
+    elif args.command == 'wishlist':
+        if args.file:
+            with open(args.file, 'rb') as f:
+                offers = list(iterWishlist(f))
+        elif args.userid:
+            offers = getWishlistByUserId(args.userid, session = session)
+        else:
+            parser.error('wishlist: a user ID or --file is required')
+        for o in offers:
+            print (u'%s\t%s\t%s %.2f\t%s\t%s\t%s' % (o.bggid, o.gametitle, o.currency,
+                o.price or 0.0, o.condition, o.seller, o.link)).encode('utf-8')
+    elif args.command == 'scan':
+        if args.file:
+            for auction in parseAuctions(readFile(args.file)):
+                print (u'%d\t%s\t%s %.2f\t%s\t%s' % (auction.bggid, auction.title,
+                    auction.currency, auction.price, auction.timeleft, auction.url)).encode('utf-8')
+        else:
+            scanEbay(configfile = args.config)
+    elif args.command == 'watch':
+        watcher = ScanWatcher(configfile = args.config, session = session,
+                              userid = args.userid,
+                              history = OfferHistory() if args.history else None,
+                              min_interval = args.min_interval,
+                              max_interval = args.max_interval)
+        watcher.run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))